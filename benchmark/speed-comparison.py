@@ -34,6 +34,11 @@ def suba_test(N):
 		ret = ''.join(template(filename="bench_suba.tpl", base_path=".", stripWhitespace=False, 
 			items = items, name="Suba"))
 
+def suba_many_test(N):
+	from suba import render_many
+	for ret in render_many("bench_suba.tpl", ({'items': items, 'name': "Suba"} for i in range(N)), root="."):
+		pass
+
 def tenjin_test(N):
 	engine = tenjin.Engine(cache=True, path=['.']) # count the one time creation cost of the engine
 	for i in range(N):
@@ -49,7 +54,7 @@ def evoque_test(N):
 	for _ in range(N):
 		(t.evoque({ 'items': items, 'name': "Evoque" }))
 
-tests = [suba_test, tenjin_test]#, evoque_test ]
+tests = [suba_test, suba_many_test, tenjin_test]#, evoque_test ]
 
 t = random.randint(0,len(tests))
 for i in range(len(tests)):
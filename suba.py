@@ -1,17 +1,37 @@
 #!/usr/bin/env python3.1
 """
-	Fast template engine, does very simple parsing (no regex, one split) and then generates the AST tree directly.
+	Fast template engine, does very simple parsing (a single scan, with one regex to match the parens of each expression)
+	and then generates the AST tree directly.
 	The AST tree is compiled to bytecode and cached (so only the first run of a template must compile).
-	The bytecode cache is in-memory only.
+	The bytecode cache is in-memory, and optionally also on disk (see: CACHE_DIR).
 """
-import re, io, os, ast, builtins, copy, time, types
+import re, io, os, ast, builtins, copy, time, types, asyncio, inspect, concurrent.futures, collections, threading, weakref, marshal, hashlib, tempfile, importlib.util
 from ast import *
 
-__all__ = ['template', 'synth']
+__all__ = ['template', 'load', 'render_many', 'Template', 'SafeString', 'add_filter', 'clear_cache', 'invalidate', 'cache_stats', 'fragment_stats', 'clear_fragments', 'synth']
 
 # to get complete compliance with all of python's type specifiers, we use a small regex
 # q and m, are added by suba
 type_re = re.compile("[0-9.#0+-]*[diouxXeEfFgGcrsqm]")
+# inside an expression, the only pieces that matter for finding its closing paren: parens, and the string literals that might hold them
+paren_re = re.compile('|'.join((r'[()]', r"'{3}(?:[^\\]|\\.)*?'{3}", r'"{3}(?:[^\\]|\\.)*?"{3}', r"'(?:[^'\\\n]|\\.)*'", r'"(?:[^"\\\n]|\\.)*"')), re.S)
+
+# set this to a directory to share compiled code between processes (see: load())
+CACHE_DIR = None
+# the most compiled templates (and included files) to hold in memory at once
+CACHE_SIZE = 1000
+# how a Template decides to check that its files have not changed, before it renders:
+#  'always': stat every file on every render
+#  a number: stat every file, at most once every so many seconds
+#  'watcher': a background thread polls the files every WATCH_INTERVAL seconds
+#  'frozen': never check, for production
+FRESHNESS = 'always'
+WATCH_INTERVAL = 1.0
+# the concurrent.futures.Executor that renders include(..., parallel=True), None uses a shared thread pool
+EXECUTOR = None
+# where %(cache:) blocks keep their output: any object with get(key) and set(key, value), such as an LRUCache
+# None uses an in-process LRUCache of CACHE_SIZE fragments
+FRAGMENT_CACHE = None
 
 class FormatError(Exception): pass # fatal, caused by parsing failure, raises to caller
 class ResourceModified(Exception): pass # non-fatal, causes refresh from disk
@@ -21,12 +41,10 @@ OPEN_MARK = '%'
 OPEN_PAREN = '('
 CLOSE_PAREN = ')'
 # lexed token
-class Token(str): pass
-class CloseMark(Token): pass
-class OpenMark(Token): pass
-class OpenParen(Token): pass
-class CloseParen(Token): pass
-class TextToken(Token): pass
+class CloseMark():
+	def __str__(self):
+		return CLOSE_MARK
+CLOSE = CloseMark()
 class ExprToken():
 	def __init__(self, text, spec=""):
 		self.text = text
@@ -44,20 +62,17 @@ class ExprToken():
 	def __getitem__(self, i):
 		return self.text[i]
 
-# by default a CLOSE_MARK will close 1 body, but in the case of elif, it might need to close more
-ASCEND_COUNT = 1
-
 # motion tokens
 class NoMotion: pass
 class Ascend: pass
 class Descend: pass
 class ElseDescend: pass
 
-def template(text=None, filename=None, stripWhitespace=False, encoding="utf8", root=".", skipCache=False, **kw):
+def template(text=None, filename=None, stripWhitespace=False, encoding="utf8", root=".", skipCache=False, cacheDir=None, autoEscape=False, freshness=None, **kw):
 	"""
 		Fast template engine, does very simple parsing and then generates the AST tree directly.
 		The AST tree is compiled to bytecode and cached (so only the first run of a template must compile).
-		The code cache is in-memory only.
+		The code cache is in-memory, and optionally on disk in cacheDir.
 
 		The most basic syntax is similar to the % string substitution operator, but without the trailing type indicator.
 		The template itself returns a generator, so you must read it out with something that will iterate it.
@@ -83,6 +98,11 @@ def template(text=None, filename=None, stripWhitespace=False, encoding="utf8", r
 		>>> ''.join(template(text="...%((str(x) for x in range(1,10)))..."))
 		'...123456789...'
 
+		Generators of generators (of any depth) are flattened too, and every piece is converted to a str.
+
+		>>> ''.join(template(text="%(((y for y in range(x)) for x in range(4)))"))
+		'001012'
+
 		You can import modules and use them in the template.
 
 		>>> import datetime
@@ -137,8 +157,60 @@ def template(text=None, filename=None, stripWhitespace=False, encoding="utf8", r
 		>>> ''.join(template(text="<p>%(include('included.suba', root='_test'))</p>", name="Mary"))
 		'<p>Thank you Mary, for the message!</p>'
 
+		An include that is slow to render, and only reads the variables around it, can be rendered in EXECUTOR,
+		at the same time as the rest of the template.  Its output is still spliced back in the right place.
+
+		>>> f = open("_test/included.suba", "w")
+		>>> f.write("<li>%(name)s</li>")
+		17
+		>>> f.close()
+		>>> ''.join(template(text="%(for name in names:)%(include('included.suba', root='_test', parallel=True))%/", names=["A", "B", "C"]))
+		'<li>A</li><li>B</li><li>C</li>'
+
 		>>> os.remove("_test/included.suba")
 
+		A template can extend another, replacing any of its named blocks.  Everything is flattened into one function when compiled.
+
+		>>> f = open("_test/base.suba", "w")
+		>>> f.write("<h1>%(block title:)Home%/</h1><div>%(block body:)%/</div>")
+		57
+		>>> f.close()
+		>>> ''.join(template(text="%(extends('base.suba'))%(block body:)Hello, %(name)s.%/", root="_test", name="Ringo"))
+		'<h1>Home</h1><div>Hello, Ringo.</div>'
+		>>> os.remove("_test/base.suba")
+
+		With autoEscape, every value is HTML-escaped, except for static text, a SafeString, or a value with the r (raw) spec.
+
+		>>> ''.join(template(text="<p>%(a)</p>%(b)%(c)r", a="<b>", b=SafeString("<i>"), c="<u>", autoEscape=True))
+		'<p>&lt;b&gt;</p><i><u>'
+		>>> ''.join(template(text="%(a|escape) %(a|safe)", a="<b>", autoEscape=True))
+		'&lt;b&gt; <b>'
+
+		The output of a macro was escaped as it was made, so when it is used as a value, it is a SafeString.
+
+		>>> ''.join(template(text="%(def li(d):)<li>%(d)</li>%/%(x = ''.join(li('<a>')))%(x)%(li('&') if x else '')", autoEscape=True))
+		'<li>&lt;a&gt;</li><li>&amp;</li>'
+
+		A value can be passed through filters, which are compiled in line where possible (see: add_filter).
+
+		>>> ''.join(template(text="%(name|upper|truncate(3)), %(names|join(', '))", name="ringo", names=["John", "Paul"]))
+		'RIN, John, Paul'
+
+		A variable of the template can still have the name of a filter, and an argument can be read as args['name'].
+
+		>>> ''.join(template(text="%(length = 2)%(a|length)d", a=1)), ''.join(template(text="%(a|args['length'])d %(b|length)d", a=1, b=[1], length=2))
+		('3', '3 1')
+
+		The output of a block can be cached, and re-used for any render with the same key, for ttl seconds (or forever).
+
+		>>> clear_fragments()
+		>>> [''.join(template(text="%(cache key=lang, ttl=60:)<nav>%(lang)s %(n)d</nav>%/", lang="en", n=n)) for n in (1, 2)]
+		['<nav>en 1</nav>', '<nav>en 1</nav>']
+		>>> fragment_stats()
+		{'hits': 1, 'misses': 1, 'size': 1}
+
+		Since the block may not run, any variables it sets are not visible after it.
+
 		You can define functions locally in the template.
 
 		>>> ''.join(template(text=\"""%(def hex(s): return int(s, 16))%(hex('111'))d""\"))
@@ -193,25 +265,85 @@ def template(text=None, filename=None, stripWhitespace=False, encoding="utf8", r
 			File "<inline_template>", line 3, in execute
 		ZeroDivisionError: division by zero
 
+		Every other keyword is an argument of the template, even one that is also an option of stream().
+
+		>>> ''.join(template(text="%(chunk_size)", chunk_size=3))
+		'3'
+
 		TODO: more tests of this line number stuff, such as with includes, etc.
 		TODO: improve the quality of these lineno tests, as doctest doesn't check the stacktrace
 	"""
+	return load(text=text, filename=filename, stripWhitespace=stripWhitespace, encoding=encoding, root=root, skipCache=skipCache, cacheDir=cacheDir, autoEscape=autoEscape, freshness=freshness)._stream('execute', kw)
+
+def load(text=None, filename=None, stripWhitespace=False, encoding="utf8", root=".", skipCache=False, cacheDir=None, autoEscape=False, freshness=None):
+	"""
+		Returns a compiled Template, ready to be rendered many times without re-compiling or re-executing the module code.
+		Takes the same arguments as template(), except for the keyword arguments that are passed to the template itself.
+
+		>>> t = load(text="<p>%(name)s</p>")
+		>>> t.render(name="John")
+		'<p>John</p>'
+		>>> ''.join(t.stream(name="Paul"))
+		'<p>Paul</p>'
+		>>> load(text="<p>%(name)s</p>") is t
+		True
+
+		The same text compiled with different options is cached separately.
+
+		>>> load(text=" a\\n b").render(), load(text=" a\\n b", stripWhitespace=True).render()
+		(' a\\n b', ' ab')
+
+		The freshness policy, None for FRESHNESS, is one of the options (see: Template).
+
+		>>> load(text="<p>%(name)s</p>", freshness='frozen').freshness
+		'frozen'
+		>>> load(text="<p>%(name)s</p>", freshness='watch')
+		Traceback (most recent call last):
+			...
+		ValueError: freshness must be 'always', 'watcher', 'frozen' or a number of seconds, not 'watch'
+
+		If cacheDir is given (or CACHE_DIR is set), compiled code is also stored on disk there,
+		so a freshly started process can skip compiling templates that some other process already compiled.
+
+		>>> load(text="<b>%(x)d</b>", cacheDir="_test/cache").render(x=1)
+		'<b>1</b>'
+		>>> files = os.listdir("_test/cache")
+		>>> len(files)
+		1
+		>>> load(text="<b>%(x)d</b>", cacheDir="_test/cache", skipCache=True).render(x=2)
+		'<b>2</b>'
+		>>> os.listdir("_test/cache") == files
+		True
+
+		Code read from cacheDir is only used if none of the files it includes have changed (or been rolled back) since it was stored.
+
+		>>> f = open("_test/part.suba", "w"); f.write("old"); f.close()
+		3
+		>>> Template(text="<b>%(include('part.suba'))</b>", root=["_test"], cacheDir="_test/cache", freshness='frozen').render()
+		'<b>old</b>'
+		>>> f = open("_test/part.suba", "w"); f.write("new"); f.close()
+		3
+		>>> os.utime("_test/part.suba", (time.time() + 10, time.time() + 10))
+		>>> Template(text="<b>%(include('part.suba'))</b>", root=["_test"], cacheDir="_test/cache", freshness='frozen').render()
+		'<b>new</b>'
+		>>> os.remove("_test/part.suba")
+		>>> for f in os.listdir("_test/cache"): os.remove(os.path.join("_test/cache", f))
+		>>> os.rmdir("_test/cache")
+	"""
+	_checkPolicy(freshness)
 	path = root.split(os.path.sep)
+	full_name = None
 
 	if text is None and filename is not None:
 		# never allow absolute paths, or '..', in filenames
 		full_name = os.path.sep.join(path + [f for f in filename.split(os.path.sep) if f != '..' and f != ''])
-		h = full_name.__hash__()
-		h += os.path.getmtime(full_name)
+		# no mtime in the key, a cached Template checks its own freshness (see: FRESHNESS)
+		h = ('template', os.path.normpath(full_name), stripWhitespace, encoding, tuple(path), autoEscape, freshness)
 	elif filename is None and text is not None:
-		if hasattr(text, "__hash__"):
-			try:
-				h = text.__hash__()
-			except TypeError:
-				print("text", text, type(text))
-				raise
-		else:
+		if getattr(text, "__hash__", None) is None:
 			raise TypeError("Type %s has no __hash__()" % type(text))
+		# the text itself is part of the key, so equal keys always mean equal sources
+		h = ('text', text, stripWhitespace, encoding, tuple(path), autoEscape, freshness)
 	else:
 		raise ArgumentError("template() requires either text= or filename= arguments.")
 
@@ -219,47 +351,344 @@ def template(text=None, filename=None, stripWhitespace=False, encoding="utf8", r
 	# note about performance: compiling time is one-time only, so on scale it matters very very little.
 	# what matters is the execution of the generated code.
 	# absolutely anything that can be done to manipulate the generated AST to save execution time should be done.
-	if skipCache or _code_cache.get(h, None) is None:
-		if filename is not None:
-			text = open(os.path.sep.join(path + [filename]), "rb").read()
+	t = None if skipCache else _code_cache.get(h)
+	if t is None:
+		with _compile_lock:
+			# check again, in case another thread compiled this template while we waited
+			t = None if skipCache else _code_cache.get(h)
+			if t is None:
+				t = Template(text=text, filename=filename, stripWhitespace=stripWhitespace, encoding=encoding, root=path,
+					cacheDir=cacheDir if cacheDir is not None else CACHE_DIR, freshness=freshness, autoEscape=autoEscape)
+				_code_cache.set(h, t, path=full_name)
+	return t
+
+def render_many(template, contexts, workers=None, **kw):
+	"""
+		Renders one template against each dict in contexts, and yields the results in the same order.
+		The template is a Template, or the filename of one (kw are then passed to load()),
+		so it is looked up and compiled only once, however many contexts there are.
+
+		>>> list(render_many(load(text="<p>%(name)s</p>"), [{'name': "John"}, {'name': "Paul"}]))
+		['<p>John</p>', '<p>Paul</p>']
+
+		If workers is given, the contexts are rendered by a pool of that many processes.
+		Each process compiles the template once when it starts (or reads it from cacheDir, see: load()).
+		The contexts, and whatever they contain, must be picklable.
+
+		>>> list(render_many(load(text="%(n * n)d,"), ({'n': n} for n in range(6)), workers=2))
+		['0,', '1,', '4,', '9,', '16,', '25,']
+	"""
+	if type(template) is str:
+		template = load(filename=template, **kw)
+	if workers is None:
+		render = template.render
+		for context in contexts:
+			yield render(**context)
+		return
+	options = dict(text=template.text, filename=template.filename, stripWhitespace=template.stripWhitespace,
+		encoding=template.encoding, root=template.root, cacheDir=template.cacheDir, freshness=template.freshness, autoEscape=template.autoEscape)
+	with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(options,)) as pool:
+		# keep only a few renders in flight per worker, so a huge (or endless) iterable of contexts is not read all at once
+		pending = collections.deque()
+		for context in contexts:
+			pending.append(pool.submit(_render_worker, context))
+			if len(pending) >= workers * 4:
+				yield pending.popleft().result()
+		while pending:
+			yield pending.popleft().result()
+
+# the Template that each render_many() worker process builds once, when it starts
+_worker_template = None
+def _init_worker(options):
+	global _worker_template
+	_worker_template = Template(**options)
+def _render_worker(context):
+	return _worker_template.render(**context)
+
+class Template:
+	""" A compiled template.  The module code is executed once, when the Template is built, so each render just calls execute().
+
+		Before each render, the Template may check that none of the files it was built from have changed.
+		How often that happens is set by self.freshness, or by FRESHNESS if that is None.
+
+		>>> os.makedirs("_test", exist_ok=True)
+		>>> f = open("_test/fresh.suba", "w"); f.write("one"); f.close()
+		3
+		>>> t = load(filename="fresh.suba", root="_test")
+		>>> t.freshness = 'frozen'
+		>>> t.render()
+		'one'
+		>>> f = open("_test/fresh.suba", "w"); f.write("two"); f.close()
+		3
+		>>> os.utime("_test/fresh.suba", (time.time() + 10, time.time() + 10))
+		>>> t.render()
+		'one'
+		>>> t.freshness = 'always'
+		>>> t.render()
+		'two'
+		>>> os.remove("_test/fresh.suba")
+	"""
+	def __init__(self, text=None, filename=None, stripWhitespace=False, encoding="utf8", root=None, cacheDir=None, freshness=None, autoEscape=False):
+		self.text = text
+		self.filename = filename
+		self.stripWhitespace = stripWhitespace
+		self.autoEscape = autoEscape
+		self.encoding = encoding
+		self.root = root if root is not None else []
+		self.cacheDir = cacheDir
+		self.freshness = _checkPolicy(freshness)
+		self.compile()
+
+	def compile(self, skipCache=False):
+		""" (Re-)reads the source and builds self.code and self.execute.
+			Unless skipCache is set, the on-disk cache (if any) is consulted before compiling. """
+		text = self.text
+		dependencies = {} # full_name -> mtime, for every file the code is built from
+		if self.filename is not None:
+			full_name = os.path.sep.join(self.root + [f for f in self.filename.split(os.path.sep) if f != '..' and f != ''])
+			# the template checks its own freshness, the same way it checks the files it includes
+			dependencies[full_name] = os.path.getmtime(full_name)
+			text = open(full_name, "rb").read()
 		if type(text) is bytes:
-			text = str(text, encoding)
-		if filename is None:
-			filename = "<inline_template>"
-		try:
-			head = compile_ast(text, stripWhitespace=stripWhitespace, encoding=encoding, root=path)
-		except IndentationError as e:
-			e.filename = filename
-			raise
-		_code_cache[h] = compile(head, filename, 'exec', 0)
-
-	## Execution Phase ##
-	# provide a few global helpers and then execute the cached byte code
-	loc = {}
-	glob = {'ResourceModified':ResourceModified}
-	# this executes the Module(), which defines a function inside loc
-	exec(_code_cache[h], glob, loc)
-	# calling execute returns the generator, without having run any of the code inside yet
-	gen = loc['execute'](**kw)
-	# we pull the first item out, causing the preamble to run, yielding either True, or a ResourceModified exception
-	for err in gen:
+			text = str(text, self.encoding)
+		filename = self.filename if self.filename is not None else "<inline_template>"
+		code = None
+		if self.cacheDir is not None:
+			cache_file = _disk_cache_file(self.cacheDir, filename, text, self.stripWhitespace, self.encoding, self.root, self.autoEscape)
+			cached = None if skipCache else _read_disk_cache(cache_file)
+			# the key only covers our own source, so check once that none of the files it includes changed since
+			if cached is not None and not _modified(cached[1]):
+				code, dependencies = cached
+		if code is None:
+			try:
+				head = compile_ast(text, stripWhitespace=self.stripWhitespace, encoding=self.encoding, root=self.root, dependencies=dependencies,
+					autoEscape=self.autoEscape)
+			except IndentationError as e:
+				e.filename = filename
+				raise
+			code = compile(head, filename, 'exec', 0)
+			if self.cacheDir is not None:
+				_write_disk_cache(cache_file, code, dependencies)
+		self.code = code
+		self.dependencies = dependencies
+		self.stale = False
+		self.checked = time.time()
+		_graph.add(self, dependencies)
+		# provide a few global helpers and then execute the byte code
+		loc = {}
+		glob = {'ResourceModified':ResourceModified, '_checkFreshness':self._checkFreshness, '_str':_flatten_str,
+			'_escape':_escape, '_safe':SafeString, '_include':self._include, '_include_bytes':self._include_bytes, '_include_async':self._include_async,
+			'_flush':_FLUSH, '_flush_bytes':_FLUSH_BYTES, '_isawaitable':inspect.isawaitable, '_parallel':_parallel, '_splice':_splice,
+			'_cache':_cache, '_cache_bytes':_cache_bytes, '_cache_async':_cache_async, '_missingArg':self._missingArg}
+		# each filter that is called at runtime is a global named _filter_<name> (see: Filter.apply)
+		for name in _globalNames(self.code):
+			if name.startswith('_filter_'):
+				glob[name] = FILTERS[name[len('_filter_'):]].func
+		# this executes the Module(), which defines the functions inside loc (see: compile_ast)
+		exec(self.code, glob, loc)
+		self.functions = loc
+		self.execute = loc.get('execute', None)
+		# only a template with parallel includes needs its stream spliced back together
+		self.parallel = _usesName(self.code, '_parallel')
+
+	def stream(self, chunk_size=None, **kw):
+		""" Returns a generator that yields the output of the template in pieces.
+			If chunk_size is given, pieces are gathered into chunks of at least that many characters,
+			except where the template says %(flush()), which yields whatever has been gathered so far right away.
+
+			>>> t = load(text="%(for i in range(5):)ab%/%(flush())<br>")
+			>>> list(t.stream(chunk_size=4))
+			['abab', 'abab', 'ab', '<br>']
+		"""
+		gen = self._stream('execute', kw)
+		return gen if chunk_size is None else _chunks(gen, chunk_size, '')
+
+	def stream_bytes(self, chunk_size=None, **kw):
+		""" Like stream(), but yields bytes in self.encoding.  Static text was encoded when the template was compiled. """
+		gen = self._stream('execute_bytes', kw)
+		return gen if chunk_size is None else _chunks(gen, chunk_size, b'')
+
+	def render(self, **kw):
+		""" Returns the complete output of the template as a single string.
+			This uses the buffered version of the code, which appends to a list instead of yielding each piece. """
+		return self._render('render', kw)
+
+	def render_bytes(self, **kw):
+		""" Like render(), but returns bytes in self.encoding, without encoding the static text again.
+
+			>>> load(text="caf\\xe9 %(x)s").render_bytes(x="cr\\xe8me")
+			b'caf\\xc3\\xa9 cr\\xc3\\xa8me'
+
+			A macro whose output is used as a value, not only output, keeps producing str.
+
+			>>> load(text="%(def li(d):)<li>%(d)</li>%/%(''.join(li('a')))%(li('b'))").render_bytes()
+			b'<li>a</li><li>b</li>'
+		"""
+		return self._render('render_bytes', kw)
+
+	def _stream(self, name, kw, reloaded=False):
+		functions = self.functions
+		if name not in functions:
+			raise TypeError("This template uses await, so it can only be used with stream_async() or render_async().")
+		# calling execute returns the generator, without having run any of the code inside yet
+		gen = functions[name](**kw)
+		# we pull the first item out, causing the preamble to run, yielding either None, or a ResourceModified exception
+		for err in gen:
+			if err is None:
+				return _splice(gen) if self.parallel else gen
+			if type(err) == ResourceModified:
+				del gen
+				self._reload(functions, reloaded)
+				return self._stream(name, kw, reloaded=True)
+			raise Exception("execute did not return a proper generator, first value was:",err)
+
+	async def stream_async(self, chunk_size=None, **kw):
+		""" An async generator version of stream().  Arguments that are awaitable are awaited first.
+			If chunk_size is given, it lets the event loop run between chunks.
+
+			>>> import asyncio
+			>>> async def upper(s): return s.upper()
+			>>> async def collect(t, **kw): return [piece async for piece in t.stream_async(chunk_size=100, **kw)]
+			>>> asyncio.run(collect(load(text="%(for n in names:)<p>%(await upper(n))</p>%/"), names=["a", "b"], upper=upper))
+			['<p>A</p><p>B</p>']
+		"""
+		gen = await self._stream_async(kw)
+		if chunk_size is not None:
+			gen = _achunks(gen, chunk_size)
+		async for piece in gen:
+			yield piece
+
+	async def render_async(self, **kw):
+		""" The async version of render().  Arguments that are awaitable are awaited first.
+
+			>>> import asyncio
+			>>> async def upper(s): return s.upper()
+			>>> asyncio.run(load(text="<b>%(x)</b>").render_async(x=upper("c")))
+			'<b>C</b>'
+			>>> async def count(n):
+			...     for i in range(n): yield i
+			>>> asyncio.run(load(text="%(async for i in count(3):)%(i)d,%/").render_async(count=count))
+			'0,1,2,'
+		"""
+		for reloaded in (False, True):
+			functions = self.functions
+			out = await functions['render_async'](**kw)
+			if type(out) is not ResourceModified:
+				return out
+			self._reload(functions, reloaded)
+
+	async def _stream_async(self, kw, reloaded=False):
+		functions = self.functions
+		gen = functions['execute_async'](**kw)
+		# just like _stream, the first item comes from the preamble
+		err = await gen.__anext__()
 		if err is None:
-			return flatten_gen(gen)
+			return gen
 		if type(err) == ResourceModified:
-			# Forcing reload.
-			del gen
-			return template(text=text, filename=filename, stripWhitespace=stripWhitespace, encoding=encoding, root=root, skipCache=True, **kw)
-		raise Exception("execute did not return a proper generator, first value was:",err)
-
-def compile_ast(text, stripWhitespace=False, encoding=None, transform=True, root=None):
-	"Builds a Module ast tree.	Containing a single function: execute, a generator function."
-	global ASCEND_COUNT
+			await gen.aclose()
+			self._reload(functions, reloaded)
+			return await self._stream_async(kw, reloaded=True)
+		raise Exception("execute_async did not return a proper generator, first value was:",err)
+
+	def _include(self, filename, root, args, scope, name='execute'):
+		""" Called from the compiled code for include(filename) when filename is an expression, not a literal.
+			Each file is compiled once, as its own Template, and cached by load(), so it shares the CACHE_SIZE bound.
+			It renders with the keyword arguments of this template, and the local variables where it is included.
+
+			>>> os.makedirs("_test", exist_ok=True)
+			>>> f = open("_test/row_plain.suba", "w"); f.write("<td>%(name)s</td>"); f.close()
+			17
+			>>> f = open("_test/row_bold.suba", "w"); f.write("<td><b>%(name)s</b></td>"); f.close()
+			24
+			>>> t = load(text="%(for name in names:)%(include('row_' + theme + '.suba'))%/", root="_test")
+			>>> t.render(theme="plain", names=["A", "B"]), t.render(theme="bold", names=["C"])
+			('<td>A</td><td>B</td>', '<td><b>C</b></td>')
+			>>> t._included('row_bold.suba', None) is load(filename='row_bold.suba', root="_test")
+			True
+			>>> os.remove("_test/row_plain.suba"); os.remove("_test/row_bold.suba")
+		"""
+		return self._included(filename, root)._stream(name, _includeArgs(args, scope))
+	def _include_bytes(self, filename, root, args, scope):
+		return self._include(filename, root, args, scope, name='execute_bytes')
+	async def _include_async(self, filename, root, args, scope):
+		async for piece in await self._included(filename, root)._stream_async(_includeArgs(args, scope)):
+			yield piece
+	def _included(self, filename, root):
+		path = root if root is not None else (os.path.sep.join(self.root) or ".")
+		return load(filename=filename, root=path, stripWhitespace=self.stripWhitespace,
+			encoding=self.encoding, cacheDir=self.cacheDir, autoEscape=self.autoEscape)
+
+	def _render(self, name, kw):
+		for reloaded in (False, True):
+			functions = self.functions
+			if name not in functions:
+				raise TypeError("This template uses await, so it can only be used with stream_async() or render_async().")
+			out = functions[name](**kw)
+			if type(out) is not ResourceModified:
+				return out
+			# otherwise, the preamble returned a ResourceModified
+			self._reload(functions, reloaded)
+
+	def _reload(self, functions, reloaded):
+		""" Recompiles the template, after the preamble of functions said one of its files changed.
+			Each render reloads at most once, if the fresh code is stale too, something keeps changing the files. """
+		if reloaded:
+			raise ResourceModified("%s was still stale after reloading it." % (self.filename or "<inline_template>"))
+		with _compile_lock:
+			if self.functions is functions: # unless another thread already reloaded it
+				# the on-disk copy (if any) is just as stale as ours
+				self.compile(skipCache=True)
+
+	def _missingArg(self, e, names):
+		""" Called from the compiled code when a NameError escapes it.
+			If it was raised by reading one of names, the arguments the template reads, then that argument was not given.
+
+			>>> load(text="%(if flag:)%(missing)%/").render(flag=True)
+			Traceback (most recent call last):
+			...
+			NameError: <inline_template> was not given the argument: missing
+		"""
+		name = e.name
+		if name is None: # an UnboundLocalError only names the variable in its message
+			m = re.search("'(\\w+)'", str(e))
+			name = m.group(1) if m is not None else None
+		if name in names:
+			raise NameError("%s was not given the argument: %s" % (self.filename or "<inline_template>", name), name=name) from e
+
+	def modified(self):
+		""" True if any file this template was built from has changed since it was compiled. """
+		return _modified(self.dependencies)
+
+	def _checkFreshness(self):
+		""" Called from the compiled preamble, returns True if this render must reload the template first.
+			Each policy only decides when to stat the files, a change to any file marks every Template built from it stale. """
+		policy = self.freshness if self.freshness is not None else FRESHNESS
+		if self.stale or policy == 'frozen':
+			return self.stale
+		if policy == 'watcher':
+			_start_watcher()
+			return self.stale
+		if policy != 'always': # then policy is a number of seconds between checks
+			now = time.time()
+			if now - self.checked < policy:
+				return False
+			self.checked = now
+		_graph.check(self.dependencies)
+		return self.stale
+
+def compile_ast(text, stripWhitespace=False, encoding=None, transform=True, root=None, dependencies=None, autoEscape=False):
+	"""Builds a Module ast tree.	Containing a function: execute, a generator function.
+	If transform is set, it also contains: render, the same code but appending to a buffer and returning a string,
+	execute_bytes and render_bytes, which do the same but produce bytes in the given encoding,
+	and execute_async and render_async, the async versions of execute and render.
+	If the template uses await, or async for, etc., only the async versions are built.
+	If autoEscape is set, every dynamic value is HTML-escaped (see: EscapeTransformer)."""
 	head = Module(body=[
 		# build the first node of the new code tree
 		# which will be a module with a single function: 'execute', a generator function
-		FunctionDef(name='execute', args=arguments(args=[], vararg=None, kwonlyargs=[], kw_defaults=[], kwarg=arg(arg='args', annotation=None), defaults=[]),
+		FunctionDef(name='execute', args=arguments(posonlyargs=[], args=[], vararg=None, kwonlyargs=[], kw_defaults=[], kwarg=arg(arg='args', annotation=None), defaults=[]),
 			body=[], decorator_list=[], returns=None, lineno=0)
-	])
+	], type_ignores=[])
 
 	cursor = [] # a stack
 	cursor.append(head.body[0].body)
@@ -274,10 +703,8 @@ def compile_ast(text, stripWhitespace=False, encoding=None, transform=True, root
 			if len(cursor) < 2:
 				raise FormatError("Too many closings tags ('%%/'), cursor: %s" % (cursor, ))
 			# as we ascend, make sure all the Expr's in the about-to-be-closed body are yielding
-			for _ in range(ASCEND_COUNT):
-				_yieldall(cursor[-1])
-				cursor = cursor[:-1]
-			ASCEND_COUNT = 1
+			_yieldall(cursor[-1])
+			cursor = cursor[:-1]
 		elif motion is Descend: # Descend opens a new block, and puts the cursor inside
 			cursor.append(expr.body) # (if, def, with, try, except, etc. all work this way)
 			del cursor[-1][0] # delete the temporary 'pass' statement
@@ -291,49 +718,555 @@ def compile_ast(text, stripWhitespace=False, encoding=None, transform=True, root
 			Import(names=[alias(name='os', asname=None, lineno=0, col_offset=0)], lineno=0, col_offset=0),
 		] + head.body[0].body
 		# patch up the generated tree, to reference the keyword arguments when necessary, etc
-		t = Transformer(stripWhitespace, encoding, root)
+		t = Transformer(stripWhitespace, encoding, root, autoEscape)
+		if dependencies is not None: # share the dict, so the caller also learns about every included file
+			t.dependencies = dependencies
+			t.including = [os.path.normpath(full_name) for full_name in dependencies] # the template's own file, if any
+		head.body[0].body = t.extend(head.body[0].body)
 		head = t.visit(head)
-		# any includes that were inlined during the transform will add freshness checks to t.preamble
-		# if the checks fail, they will yield an exception (not raise it)
-		# template() above always reads the first item from the generator
+		# any includes that were inlined during the transform were added to t.dependencies
+		# if any of those files changed, the Template's _checkFreshness() says so (see: DependencyGraph)
+		# and the preamble yields an exception (not raise it), so the Template can reload
+		preamble = []
+		if len(t.dependencies) > 0:
+			preamble.append(If(test=_call(Name(id='_checkFreshness', ctx=Load()), []),
+				body=[Expr(value=Yield(value=_call(Name(id='ResourceModified', ctx=Load()), [])))], orelse=[]))
+		# Template.stream() always reads the first item from the generator
 		# if none of the checks yielded (so it's all safe to proceed with this cached template)
-		# then we must yield None to release the generator to the caller see: the end of template()
-		t.preamble.append(Expr(value=Yield(value=Name(id='None', ctx=Load()))))
+		# then we must yield None to release the generator to the caller see: the end of Template.stream()
+		preamble.append(Expr(value=Yield(value=NameConstant(value=None))))
+		# then copy each keyword argument the template reads into a real local, once, so every later read is a LOAD_FAST
+		preamble.extend(_unpackArg(name) for name in t.argNames)
+		body = head.body[0].body[1:] or [Pass()]
+		if len(t.argNames) > 0:
+			# a read of an argument that was not given raises a NameError, which _missingArg() says more about
+			# try: body
+			# except NameError as _e:
+			#   _missingArg(_e, names)
+			#   raise
+			body = [ast.copy_location(Try(body=body, handlers=[ExceptHandler(type=Name(id='NameError', ctx=Load()), name='_e', body=[
+					Expr(value=_call(Name(id='_missingArg', ctx=Load()), [Name(id='_e', ctx=Load()), Tuple(elts=[Str(s=name) for name in t.argNames], ctx=Load())])),
+					Raise(exc=None, cause=None)])],
+				orelse=[], finalbody=[]), body[0])]
 		# now insert the preamble into the proper spot in the body (after the import, before the real stuff)
-		head.body[0].body[1:1] = t.preamble
+		head.body[0].body[1:] = preamble + body
 		del t
+		if autoEscape: # before the constants are folded, so a raw (r) spec still applies to them
+			head.body[0] = EscapeTransformer().visit(head.body[0])
+		# fold constants and merge the many small static yields into as few as possible
+		head = optimize_ast(head)
+		# then render the rows of each simple loop with a single join
+		head.body[0] = LoopTransformer(head.body[0]).visit(head.body[0])
+		# and fuse each run of text and values that is left into one f-string
+		head = fuse_ast(head)
+		# make every piece yielded a str, flattening generators in place, so the caller can use them as is
+		head.body[0] = StrYieldTransformer().visit(head.body[0])
+		execute = head.body[0]
+		# the async versions work for every template
+		execute_async = AsyncTransformer(execute).visit(copy.deepcopy(execute))
+		head.body = [execute_async, buffer_ast(execute_async, name='render_async')]
+		# but a template that awaits can't have the others
+		if not _isAsync(execute.body):
+			# so build the buffered twin of execute, and the bytes versions of both
+			execute_bytes = BytesTransformer(encoding or "utf8", _valueMacros(execute)).visit(copy.deepcopy(execute))
+			execute_bytes.name = 'execute_bytes'
+			head.body[0:0] = [execute, buffer_ast(execute), execute_bytes, buffer_ast(execute_bytes, name='render_bytes')]
 		# then fill in any missing lineno, col_offsets so that compile() wont complain
 		ast.fix_missing_locations(head)
 
 	# print("COMPILED: ", ast.dump(head))
 	return head
 
+def buffer_ast(fundef, name='render'):
+	""" Given the execute FunctionDef, returns a copy named render, that appends everything execute would yield to a list, and returns it joined.
+		If fundef is execute_bytes (see: BytesTransformer), the pieces are bytes, and are joined as bytes.
+
+		>>> print(ast.unparse(buffer_ast(ast.parse("def execute(**args):\\n yield None\\n yield 'a'\\n yield '%d' % x\\n yield x").body[0])))
+		def render(**args):
+		    _buf = []
+		    _append = _buf.append
+		    _extend = _buf.extend
+		    _append('a')
+		    _append('%d' % x)
+		    _append(_value if type((_value := x)) is str else _str(_value))
+		    return ''.join(_buf)
+	"""
+	isBytes = fundef.name == 'execute_bytes'
+	fundef = copy.deepcopy(fundef)
+	fundef.name = name
+	fundef.body = [
+		Assign(targets=[Name(id='_buf', ctx=Store())], value=List(elts=[], ctx=Load())),
+		Assign(targets=[Name(id='_append', ctx=Store())], value=Attribute(value=Name(id='_buf', ctx=Load()), attr='append', ctx=Load())),
+		Assign(targets=[Name(id='_extend', ctx=Store())], value=Attribute(value=Name(id='_buf', ctx=Load()), attr='extend', ctx=Load())),
+	] + BufferTransformer(isBytes).visit(Module(body=fundef.body, type_ignores=[])).body
+	pieces = Name(id='_buf', ctx=Load())
+	if any(type(node) is Name and node.id == '_parallel' for node in ast.walk(fundef)):
+		pieces = _call(Name(id='_splice', ctx=Load()), [pieces]) # some of the pieces are Futures
+	fundef.body.append(Return(value=_call(Attribute(value=Constant(value=b'' if isBytes else ''), attr='join', ctx=Load()), [pieces])))
+	return ast.fix_missing_locations(fundef)
+
+class BufferTransformer(ast.NodeTransformer):
+	""" Rewrites the yields in the body of execute into appends to _buf (see: buffer_ast). """
+	def __init__(self, isBytes=False):
+		ast.NodeTransformer.__init__(self)
+		self.isBytes = isBytes
+	def visit_Expr(self, node):
+		if type(node.value) is YieldFrom: # a macro call, or a generator expression, its pieces go straight into our buffer
+			value = node.value.value
+			if type(value) is GeneratorExp: # a list is built faster, and extends faster, than a generator
+				value = ast.copy_location(ListComp(elt=value.elt, generators=value.generators), value)
+			return ast.copy_location(Expr(value=_call(Name(id='_extend', ctx=Load()), [value])), node)
+		if type(node.value) is not Yield:
+			return node
+		value = node.value.value
+		if value is None or (type(value) is Constant and value.value is None):
+			return None # the yield None that releases the generator, in Template.stream()
+		if type(value) is Call and type(value.func) is Name and value.func.id == 'ResourceModified':
+			return ast.copy_location(Return(value=value), node) # see: Template.render()
+		if not self.isBytes and not _isParallel(value): # bytes pieces were already made safe by BytesTransformer
+			value = _strExpr(value)
+		return ast.copy_location(Expr(value=_call(Name(id='_append', ctx=Load()), [value])), node)
+	def visit_FunctionDef(self, node):
+		return node # functions defined in the template keep yielding (str pieces, see: StrYieldTransformer)
+	def visit_AsyncFunctionDef(self, node):
+		return node
+	def visit_ClassDef(self, node):
+		return node
+
+class StrYieldTransformer(ast.NodeTransformer):
+	""" Makes every yield in a tree produce only str pieces, so nothing needs to flatten or convert them at runtime.
+
+		>>> print(ast.unparse(StrYieldTransformer().visit(ast.parse("yield 'a'\\nyield x\\nyield (y for y in z)"))))
+		yield 'a'
+		yield (_value if type((_value := x)) is str else _str(_value))
+		yield from (_value if type((_value := y)) is str else _str(_value) for y in z)
+	"""
+	def visit_Yield(self, node):
+		self.generic_visit(node)
+		value = node.value
+		if value is None or (type(value) is Constant and value.value is None):
+			return node # the yield None that releases the generator, in Template.stream()
+		if type(value) is Call and type(value.func) is Name and value.func.id == 'ResourceModified':
+			return node
+		if _isParallel(value):
+			return node # yields a Future, see: _splice()
+		if type(value) is GeneratorExp: # statically known to be a generator, so stream it
+			value.elt = _strExpr(value.elt)
+			return ast.copy_location(YieldFrom(value=value), node)
+		node.value = _strExpr(value)
+		return node
+
+class EscapeTransformer(ast.NodeTransformer):
+	""" Wraps every dynamic value yielded in a call to _escape().  Static text, numbers, and the output of macros are left alone.
+		The r spec means raw: the value is output as is, without escaping (so with autoEscape, it no longer means repr).
+
+		>>> print(ast.unparse(EscapeTransformer().visit(ast.parse("yield '<p>'\\nyield x\\nyield '%.2f' % y\\nyield '%5s' % z\\nyield '%r' % html"))))
+		yield '<p>'
+		yield _escape(x)
+		yield ('%.2f' % y)
+		yield ('%5s' % _escape(z))
+		yield ('%s' % html)
+	"""
+	def visit_Yield(self, node):
+		self.generic_visit(node)
+		value = node.value
+		if value is None or type(value) is Constant:
+			return node
+		if type(value) is Name and value.id == '_flush':
+			return node
+		if type(value) is Call and type(value.func) is Name and value.func.id in ('ResourceModified', '_parallel', '_cache', '_safe'):
+			return node
+		if type(value) is GeneratorExp:
+			value.elt = _call(Name(id='_escape', ctx=Load()), [value.elt])
+			return node
+		if type(value) is BinOp and type(value.op) is Mod and _isStrConstant(value.left):
+			spec = value.left.value
+			if spec[-1] in 'diouxXeEfFgG':
+				return node # numbers never need escaping
+			if spec[-1] == 'r':
+				value.left.value = spec[:-1] + 's'
+				return node
+			if spec[-1] == 's':
+				value.right = _call(Name(id='_escape', ctx=Load()), [value.right])
+				return node
+		node.value = ast.copy_location(_call(Name(id='_escape', ctx=Load()), [value]), value)
+		return node
+
+class BytesTransformer(ast.NodeTransformer):
+	""" Makes every yield in a tree (already made str-only by StrYieldTransformer) produce bytes.
+		Constant text is encoded once, here, so only dynamic values are encoded at runtime.
+
+		>>> print(ast.unparse(BytesTransformer('utf8').visit(ast.parse("yield 'a'\\nyield '%d' % x\\nyield from (str(y) for y in z)\\nyield f'<b>{str(y)}%</b>'"))))
+		yield b'a'
+		yield ('%d' % x).encode('utf8')
+		yield from (str(y).encode('utf8') for y in z)
+		yield (b'<b>%b%%</b>' % (str(y).encode('utf8'),))
+
+		The static text of an f-string (see: fuse_ast) is encoded here too, and its values are formatted into it with %b.
+
+		A macro in valueMacros (see: _valueMacros) keeps yielding str, where it is streamed its pieces are encoded.
+	"""
+	def __init__(self, encoding, valueMacros=()):
+		ast.NodeTransformer.__init__(self)
+		self.encoding = encoding
+		self.valueMacros = valueMacros
+	def encode(self, value):
+		if type(value) is Name and value.id == '_flush':
+			return ast.copy_location(Name(id='_flush_bytes', ctx=Load()), value)
+		if type(value) is Call and type(value.func) is Name and value.func.id == '_cache':
+			value.func.id = '_cache_bytes' # the fragment was made to yield bytes
+			return value
+		if type(value) is Constant and type(value.value) is str:
+			return ast.copy_location(Constant(value=value.value.encode(self.encoding)), value)
+		if type(value) is JoinedStr:
+			fmt, values = [], []
+			for v in value.values:
+				if _isStrConstant(v):
+					fmt.append(v.value.encode(self.encoding).replace(b'%', b'%%'))
+					continue
+				fmt.append(b'%b')
+				if type(v) is FormattedValue and v.conversion == -1 and v.format_spec is None and _isStr(v.value):
+					v = v.value
+				else: # formatting is needed to make it a str
+					v = JoinedStr(values=[v])
+				values.append(_call(Attribute(value=v, attr='encode', ctx=Load()), [Str(s=self.encoding)]))
+			return ast.copy_location(BinOp(left=Constant(value=b''.join(fmt)), op=Mod(), right=Tuple(elts=values, ctx=Load())), value)
+		return ast.copy_location(_call(Attribute(value=value, attr='encode', ctx=Load()), [Str(s=self.encoding)]), value)
+	def visit_Yield(self, node):
+		self.generic_visit(node)
+		value = node.value
+		if value is None or (type(value) is Constant and value.value is None):
+			return node
+		if type(value) is Call and type(value.func) is Name and value.func.id == 'ResourceModified':
+			return node
+		if _isParallel(value):
+			return node # the section itself was made to yield bytes
+		node.value = self.encode(value)
+		return node
+	def visit_Call(self, node):
+		self.generic_visit(node)
+		if type(node.func) is Name and node.func.id == '_include':
+			node.func.id = '_include_bytes' # a dynamic include, rendered by the included Template's execute_bytes
+		return node
+	def visit_FunctionDef(self, node):
+		if node.name in self.valueMacros:
+			return node # its output is also used as a str
+		self.generic_visit(node)
+		return node
+	def visit_YieldFrom(self, node):
+		self.generic_visit(node)
+		if type(node.value) in (GeneratorExp, ListComp): # a generator expression, or the rows of a loop (see: LoopTransformer)
+			node.value.elt = self.encode(node.value.elt)
+		elif type(node.value) is Call and type(node.value.func) is Name and node.value.func.id in self.valueMacros:
+			# yield from (_piece.encode(encoding) for _piece in macro(...))
+			node.value = ast.copy_location(GeneratorExp(elt=self.encode(Name(id='_piece', ctx=Load())),
+				generators=[comprehension(target=Name(id='_piece', ctx=Store()), iter=node.value, ifs=[], is_async=0)]), node.value)
+		return node # otherwise, it is a macro, and this transformer also made it yield bytes
+
+class AsyncTransformer(ast.NodeTransformer):
+	""" Turns a copy of execute into execute_async: an async generator, whose macros are async generators too.
+		Since async generators can't 'yield from', each yield from becomes a loop (an async for, for a macro).
+		Each argument that is awaitable is awaited as it is unpacked.
+		A macro whose output is used as a value (see: _valueMacros), and any macro it uses, stays a plain generator.
+	"""
+	def __init__(self, execute):
+		ast.NodeTransformer.__init__(self)
+		self.execute = execute
+		defs = dict((node.name, node) for node in ast.walk(execute) if type(node) is FunctionDef and node is not execute and _isGenerator(node.body))
+		# the macros that must stay plain generators
+		sync = set()
+		todo = list(_valueMacros(execute))
+		while len(todo) > 0:
+			name = todo.pop()
+			if name not in sync:
+				sync.add(name)
+				todo.extend(n.id for n in ast.walk(defs[name]) if type(n) is Name and n.id in defs)
+		for name in sync:
+			if _isAsync(defs[name].body):
+				raise FormatError("The output of %s() is used as a value, so it can't await." % name)
+		self.sync = sync
+		# the rest of the macros, which will all become async generators
+		self.macros = set(defs) - sync
+	def visit_FunctionDef(self, node):
+		if node.name in self.sync:
+			return node
+		self.generic_visit(node)
+		if node.name == 'execute' or node.name in self.macros:
+			new = AsyncFunctionDef(name=node.name + '_async' if node.name == 'execute' else node.name,
+				args=node.args, body=node.body, decorator_list=node.decorator_list, returns=node.returns)
+			return ast.copy_location(new, node)
+		return node
+	def visit_Try(self, node):
+		self.generic_visit(node)
+		name = getattr(node, 'argName', None)
+		if name is not None: # unpacking an argument, see: _unpackArg()
+			# if _isawaitable(name): name = await name
+			node.body.append(If(test=_call(Name(id='_isawaitable', ctx=Load()), [Name(id=name, ctx=Load())]),
+				body=[Assign(targets=[Name(id=name, ctx=Store())], value=Await(value=Name(id=name, ctx=Load())))], orelse=[]))
+		return node
+	def visit_Expr(self, node):
+		self.generic_visit(node)
+		if type(node.value) is Yield and _isParallel(node.value.value):
+			# the section became an async macro, so it just runs in line
+			node.value = ast.copy_location(YieldFrom(value=node.value.value.args[0]), node.value)
+		if type(node.value) is Yield and type(node.value.value) is Call and type(node.value.value.func) is Name and node.value.value.func.id == '_cache':
+			# the fragment became an async macro, so use the coroutine that can run it
+			node.value.value.func.id = '_cache_async'
+			node.value.value = ast.copy_location(Await(value=node.value.value), node.value.value)
+		if type(node.value) is not YieldFrom:
+			return node
+		value = node.value.value
+		if type(value) is Call and type(value.func) is Name and value.func.id == '_include':
+			value.func.id = '_include_async' # a dynamic include, see: Template._include_async
+		isMacro = type(value) is Call and type(value.func) is Name and value.func.id in self.macros | {'_include_async'}
+		loop = AsyncFor if isMacro or _isAsync([value]) else For
+		# for _piece in value: yield _piece
+		return ast.copy_location(loop(target=Name(id='_piece', ctx=Store()), iter=value,
+			body=[Expr(value=Yield(value=Name(id='_piece', ctx=Load())))], orelse=[]), node)
+
+def _isAsync(body):
+	""" True if the statements in body await, not counting any functions defined inside them. """
+	todo = list(body)
+	while len(todo) > 0:
+		node = todo.pop()
+		if type(node) in (Await, AsyncFor, AsyncWith) or (type(node) is comprehension and node.is_async):
+			return True
+		if type(node) not in (FunctionDef, AsyncFunctionDef, ClassDef, Lambda):
+			todo.extend(ast.iter_child_nodes(node))
+	return False
+
+def _strExpr(value):
+	""" value if type(value) is str else _str(value), evaluating value only once """
+	if _isStr(value):
+		return value
+	return ast.copy_location(IfExp(test=Compare(left=_call(Name(id='type', ctx=Load()), [NamedExpr(target=Name(id='_value', ctx=Store()), value=value)]),
+			ops=[Is()], comparators=[Name(id='str', ctx=Load())]),
+		body=Name(id='_value', ctx=Load()), orelse=_call(Name(id='_str', ctx=Load()), [Name(id='_value', ctx=Load())])), value)
+
+def _isStr(node):
+	""" True if node will always evaluate to a str. """
+	if type(node) is Constant:
+		return type(node.value) is str
+	if type(node) is BinOp and type(node.op) is Mod: # '%'+spec formatting
+		return type(node.left) is Constant and type(node.left.value) is str
+	if type(node) is JoinedStr:
+		return True
+	if type(node) is Call and type(node.func) is Name and node.func.id in ('str', '_str', '_cache', '_escape', '_safe'):
+		return True
+	if type(node) is Name and node.id in ('_flush', '_piece'): # _piece: the str pieces of a macro (see: AsyncTransformer)
+		return True
+	if type(node) is IfExp: # such as the one built by _strExpr
+		return _isStr(node.orelse) and (_isStr(node.body) or type(node.body) is Name and node.body.id == '_value')
+	if type(node) is Call and type(node.func) is Attribute and node.func.attr in ('upper', 'lower', 'strip', 'title', 'capitalize', 'replace'):
+		return _isStr(node.func.value) # such as the inlined filters, str(x).upper()
+	if type(node) is Subscript and type(node.slice) is Slice:
+		return _isStr(node.value)
+	if type(node) is Call and type(node.func) is Attribute and node.func.attr == 'join': # ''.join(...)
+		return type(node.func.value) is Constant and type(node.func.value.value) is str
+	return False
+
+def optimize_ast(tree):
+	""" Pre-formats constant expressions, then merges each run of adjacent constant string yields into one, and removes empty ones.
+
+		>>> print(ast.unparse(optimize_ast(ast.parse("yield 'a'\\nyield '%s' % 'b'\\nyield ''\\nyield x\\nyield 'c'"))))
+		yield 'ab'
+		yield x
+		yield 'c'
+	"""
+	for node in ast.walk(tree):
+		for field in ('body', 'orelse', 'finalbody'):
+			body = getattr(node, field, None)
+			if type(body) is list and len(body) > 0 and isinstance(body[0], ast.stmt):
+				setattr(node, field, _coalesce(body))
+	return tree
+
+class LoopTransformer(ast.NodeTransformer):
+	""" Compiles each simple loop, one whose body only yields, into a generator expression of its rows.
+		The pieces of a row are fused into one f-string, so each row is built by a single BUILD_STRING.
+		The stream still yields each row as soon as it is built, and the buffered code (see: buffer_ast)
+		extends its buffer with a list of all the rows, built by a single comprehension.
+
+		>>> fundef = ast.parse("def execute():\\n for item in items:\\n  yield '<td>'\\n  yield '%.2f' % item['price']\\n  yield '</td>'").body[0]
+		>>> print(ast.unparse(LoopTransformer(fundef).visit(fundef)))
+		def execute():
+		    yield from (f"<td>{'%.2f' % item['price']}</td>" for item in items)
+
+		Only a loop whose variables are not used after it qualifies, since a comprehension has its own scope.
+	"""
+	def __init__(self, fundef):
+		ast.NodeTransformer.__init__(self)
+		self.names = collections.Counter(n.id for n in ast.walk(fundef) if type(n) is Name)
+	def visit_For(self, node):
+		self.generic_visit(node) # inner loops first, so nested loops fuse too
+		if len(node.orelse) > 0 or any(type(n) not in (Name, Tuple, Store) for n in ast.walk(node.target)):
+			return node
+		inside = collections.Counter(n.id for n in ast.walk(node) if type(n) is Name)
+		if any(inside[n.id] != self.names[n.id] for n in ast.walk(node.target) if type(n) is Name):
+			return node # the loop variable is read after the loop
+		row = _rowString(node.body)
+		if row is None:
+			return node
+		# a comprehension can't hold an assignment expression (:=) in an iterable, or one that sets its own variables
+		generators = [node] + [n for n in ast.walk(row) if type(n) is comprehension]
+		targets = set(n.id for g in generators for n in ast.walk(g.target) if type(n) is Name)
+		if any(type(n) is NamedExpr for g in generators for n in ast.walk(g.iter)) \
+				or any(type(n) is NamedExpr and n.target.id in targets for n in ast.walk(row)):
+			return node
+		rows = GeneratorExp(elt=row, generators=[comprehension(target=node.target, iter=node.iter, ifs=[], is_async=0)])
+		rows.isRows = True # so an outer loop can fuse it into its own rows
+		return ast.copy_location(Expr(value=YieldFrom(value=rows)), node)
+
+def _rowString(body):
+	""" If every statement in body yields a plain value, returns a JoinedStr (an f-string) that produces them all at once. """
+	values = []
+	for expr in body:
+		pieces = _stringPieces(expr)
+		if pieces is None:
+			return None
+		values.extend(pieces)
+	return _joinedStr(values)
+
+def _stringPieces(expr):
+	""" If expr yields a plain value (or is a fused inner loop), returns the values of a JoinedStr that produces the same str. """
+	if type(expr) is Expr and type(expr.value) is YieldFrom and getattr(expr.value.value, 'isRows', False): # an inner loop, already fused
+		rows = ListComp(elt=expr.value.value.elt, generators=expr.value.value.generators)
+		return [FormattedValue(value=_call(Attribute(value=Str(s=''), attr='join', ctx=Load()), [rows]), conversion=-1, format_spec=None)]
+	if type(expr) is not Expr or type(expr.value) is not Yield or expr.value.value is None:
+		return None
+	value = expr.value.value
+	if type(value) is Constant and value.value is None: # the preamble's yield None
+		return None
+	if any(type(n) in (Yield, YieldFrom, Await, GeneratorExp) for n in ast.walk(value)):
+		return None
+	if (type(value) is Name and value.id == '_flush') or (type(value) is Call and type(value.func) is Name and value.func.id.startswith('_')
+			and value.func.id not in ('_escape', '_str', '_safe')):
+		return None # the special yields, like ResourceModified, _parallel, _cache
+	if _isStrConstant(value):
+		return [value]
+	if type(value) is JoinedStr:
+		return value.values
+	# a str, exactly, is formatted as is, without calling format()
+	return [FormattedValue(value=value if _isStr(value) else _strExpr(value), conversion=-1, format_spec=None)]
+
+def _joinedStr(values):
+	""" A JoinedStr of values, with adjacent constants merged. """
+	merged = []
+	for v in values:
+		if _isStrConstant(v) and len(merged) > 0 and _isStrConstant(merged[-1]):
+			merged[-1] = ast.copy_location(Constant(value=merged[-1].value + v.value), merged[-1])
+		else:
+			merged.append(v)
+	return JoinedStr(values=merged)
+
+def fuse_ast(tree):
+	""" Fuses each run of adjacent yields of static text and values into a single yield of an f-string,
+		so the run costs one BUILD_STRING, and one yield (or append), instead of one for each piece.
+
+		>>> print(ast.unparse(fuse_ast(ast.parse("yield '<td>'\\nyield '%.4f' % change\\nyield '</td>'\\nyield _flush\\nyield x"))))
+		yield f"<td>{'%.4f' % change}</td>"
+		yield _flush
+		yield x
+	"""
+	for node in ast.walk(tree):
+		for field in ('body', 'orelse', 'finalbody'):
+			body = getattr(node, field, None)
+			if type(body) is list and len(body) > 0 and isinstance(body[0], ast.stmt):
+				setattr(node, field, _fuse(body))
+	return tree
+
+def _fuse(body):
+	out = []
+	run = [] # the statements of the current run, and their pieces
+	for expr in body + [None]:
+		pieces = _stringPieces(expr) if expr is not None else None
+		if pieces is not None and not (type(expr.value) is YieldFrom):
+			run.append((expr, pieces))
+			continue
+		if len(run) > 1:
+			first = run[0][0]
+			out.append(ast.copy_location(Expr(value=ast.copy_location(Yield(value=_joinedStr([v for _, p in run for v in p])), first.value)), first))
+		else:
+			out.extend(e for e, _ in run)
+		run = []
+		if expr is not None:
+			out.append(expr)
+	return out
+
+def _coalesce(body):
+	out = []
+	for expr in body:
+		s = _constantYield(expr)
+		if s is None:
+			out.append(expr)
+		elif len(s) > 0:
+			prev = _constantYield(out[-1]) if len(out) > 0 else None
+			if prev is not None:
+				out[-1].value.value = Str(s=prev + s)
+			else:
+				expr.value.value = ast.copy_location(Str(s=s), expr.value.value)
+				out.append(expr)
+	if len(out) == 0: # every yield was empty, but a body can't be
+		out.append(ast.copy_location(Pass(), body[0]))
+	return out
+
+def _constantYield(expr):
+	""" If expr is a statement that yields a constant string, returns that string, otherwise None. """
+	if type(expr) is Expr and type(expr.value) is Yield and expr.value.value is not None:
+		s = _fold(expr.value.value)
+		if type(s) is str:
+			return s
+	return None
+
+def _fold(node):
+	""" Returns the value of node, if it can be computed at compile time, otherwise None. """
+	if type(node) is Constant:
+		return node.value
+	if type(node) is BinOp and type(node.op) is Mod:
+		# the '%'+spec formatting that gen_ast wraps around values
+		left, right = _fold(node.left), _fold(node.right)
+		if type(left) is str and type(right) in (str, int, float):
+			try:
+				return left % right
+			except (TypeError, ValueError):
+				return None
+	elif type(node) is Call and type(node.func) is Attribute and node.func.attr == 'replace' and len(node.args) == 2 and len(node.keywords) == 0:
+		# the .replace() calls of the q and m specs
+		s, args = _fold(node.func.value), [_fold(a) for a in node.args]
+		if type(s) is str and type(args[0]) is str and type(args[1]) is str:
+			return s.replace(args[0], args[1])
+	return None
+
 def gen_tokens(text, start=0):
-	"""A generator that does lexing for our parser. Yields Tokens."""
+	"""A generator that does lexing for our parser.
+	Yields plain str for text, an ExprToken for each %(...), and CLOSE for each %/.
 
-	while -1 < start < len(text):
-		i = text.find(OPEN_MARK,start)
+		>>> list(map(str, gen_tokens("a%(f(')'))s%/b%c")))
+		['a', "f(')')", '/', 'b', '%', 'c']
+	"""
+	end = len(text)
+	while -1 < start < end:
+		i = text.find(OPEN_MARK, start)
 		if i == -1:
-			yield TextToken(text[start:])
+			yield text[start:]
 			break
-		yield TextToken(text[start:i])
-		if text[i+1] == OPEN_PAREN:
-			m = match_forward(text, CLOSE_PAREN, OPEN_PAREN, start=i+2)
+		if i > start:
+			yield text[start:i]
+		if text.startswith(OPEN_PAREN, i+1):
+			m = match_paren(text, i+2)
 			if m == -1:
 				raise FormatError("Unmatched %s%s starting at '%s'" % (OPEN_MARK, OPEN_PAREN, text[i:i+40]))
-			text_part = text[m+1:]
-			type_part = None
-			ma = type_re.match(text_part)
 			start = m + 1
+			ma = type_re.match(text, start)
 			if ma is not None:
-				type_part = ma.group(0)
-				start += len(type_part)
-			yield ExprToken(text[i+2:m], type_part)
-		elif text[i+1] == CLOSE_MARK:
-			yield CloseMark()
+				start = ma.end()
+				yield ExprToken(text[i+2:m], ma.group(0))
+			else:
+				yield ExprToken(text[i+2:m], None)
+		elif text.startswith(CLOSE_MARK, i+1):
+			yield CLOSE
 			start = i + 2
-		else:
-			yield OpenMark()
+		else: # a lone OPEN_MARK is just text
+			yield OPEN_MARK
 			start = i + 1
 
 def linecount(t):
@@ -343,32 +1276,33 @@ def gen_ast(tokens):
 	""" Given an iterable of tokens, yields a series of [<ast>,<motion>] pairs.
 
 		>>> [ (ast.dump(x),y.__name__) for x,y in gen_ast(gen_tokens("abc%(123)def%g")) ]
-		[("Expr(value=Yield(value=Str(s='abc')))", 'NoMotion'), ("Expr(value=Yield(value=BinOp(left=Str(s='%d'), op=Mod(), right=Num(n=123))))", 'NoMotion'), ("Expr(value=Yield(value=Str(s='ef%g')))", 'NoMotion')]
+		[("Expr(value=Yield(value=Constant(value='abc')))", 'NoMotion'), ("Expr(value=Yield(value=BinOp(left=Constant(value='%d'), op=Mod(), right=Constant(value=123))))", 'NoMotion'), ("Expr(value=Yield(value=Constant(value='ef%g')))", 'NoMotion')]
 
-		>>> list(gen_tokens("/*comment*/%(for i in range(1):) foo%//*comment2*/"))
-		[('/*comment*/', None), ('(for i in range(1):)', None), (' foo', None), ('/', None), ('/*comment2*/', None)]
+		>>> list(map(str, gen_tokens("/*comment*/%(for i in range(1):) foo%//*comment2*/")))
+		['/*comment*/', 'for i in range(1):', ' foo', '/', '/*comment2*/']
 
 		>>> [ (ast.dump(x),y.__name__) for x,y in gen_ast(gen_tokens("/*comment*/%('foo')")) ]
-		[("Expr(value=Yield(value=Str(s='/*comment*/')))", 'NoMotion'), ("Expr(value=Str(s='foo'))", 'NoMotion')]
+		[("Expr(value=Yield(value=Constant(value='/*comment*/')))", 'NoMotion'), ("Expr(value=Constant(value='foo'))", 'NoMotion')]
 
 	"""
-	global ASCEND_COUNT
 	stack = []
+	# by default a CLOSE_MARK will close 1 body, but in the case of elif, it might need to close more
+	# so for each open block, this holds how many bodies its CLOSE_MARK must close
+	blocks = []
 	lineno = 1
 	# a closure to assign the lineno to all nodes
 	def locate(n):
 		if n is not None:
 			for node in ast.walk(n):
-				node.lineno = lineno
+				node.lineno = node.end_lineno = lineno
 				node.col_offset = 0
 		return n
 
 	for token in tokens:
 
 		# if it's a plain piece of text
-		if isinstance(token, TextToken):
-			if len(token) > 0:
-				stack.append(token) # stack it up
+		if type(token) is str:
+			stack.append(token) # stack it up
 			continue # get the next token
 		# otherwise, it is something we will need to eval
 
@@ -381,13 +1315,15 @@ def gen_ast(tokens):
 			stack = []
 
 		# if it's a close marker
-		if isinstance(token, CloseMark):
-			# yield the Ascend motion for the cursor
-			yield None, Ascend
-		elif isinstance(token, ExprToken):
+		if token is CLOSE:
+			# yield the Ascend motions for the cursor
+			for _ in range(blocks.pop() if len(blocks) > 0 else 1):
+				yield None, Ascend
+		else:
 			# set up the default node, motion we will yield based on what we find inside this OPEN_PAREN
 			node = None
 			motion = NoMotion
+			elif_ = False
 			# if the statement to eval is like an if, while, or for, then we need to do some tricks
 			if token.endswith(":"):
 				motion = Descend
@@ -395,11 +1331,17 @@ def gen_ast(tokens):
 			if token.startswith("else:"):
 				motion = ElseDescend
 			else:
+				if motion is Descend and (token.startswith("cache ") or token.startswith("cache:")):
+					# parse a cache block as: with cache(<arguments>):  (see: Transformer.visit_With)
+					token = ExprToken("with cache(%s):" % token.text[5:-1].strip(), token.spec)
+				elif motion is Descend and token.startswith("block "):
+					# parse a named block as: with block('<name>'):  (see: Transformer.extend)
+					token = ExprToken("with block(%r):" % token.text[6:-1].strip(), token.spec)
 				if token.startswith("elif "):
 					yield None, ElseDescend # yield an immediate else descend
 					token = ExprToken(token.text[2:], token.spec) # chop off the 'el' so we parse as a regular 'if' statement
 					motion = Descend # then the 'if' statement from this line will descend regularly
-					ASCEND_COUNT += 1
+					elif_ = True
 				try: # parse the token
 					toparse = str(token)
 					if motion is Descend:
@@ -427,25 +1369,24 @@ def gen_ast(tokens):
 						# so just put the type_part on the stack as regular text to be yielded
 						stack.append(token.spec)
 					else:
-						# q and m are special modifiers used only in suba
-						fq = token.spec.find('q')
-						fm = token.spec.find('m')
-						if fq > -1:
-							new = _quote(node.value)
-							node = ast.copy_location(new, node.value)
-						if fm > -1:
-							new = _multiline(node.value)
+						# q and m are special modifiers used only in suba, they are the filters of the same name (see: FILTERS)
+						filters = [f for f in 'qm' if f in token.spec]
+						for f in filters:
+							new = Expr(value=FILTERS[f].apply(f, node.value, []))
 							node = ast.copy_location(new, node.value)
 						# for the default types, just pass the token.spec on to the Mod operator
-						if fq == -1 and fm == -1:
+						if len(filters) == 0:
 							new = Expr(value=Yield(value=BinOp(left=Str(s='%'+token.spec), op=Mod(), right=node.value)))
 							node = ast.copy_location(new, node.value)
 
+			if motion is Descend:
+				if elif_ and len(blocks) > 0:
+					blocks[-1] += 1 # the new 'if' is nested in the orelse of the open one, so closing must ascend past both
+				else:
+					blocks.append(1)
 			# yield the parsed node
 			# print("gen_ast:", ast.dump(node, include_attributes=True))
 			yield node, motion
-		else:
-			stack.append(token)
 
 	if len(stack) > 0:
 		# yield the remaining text
@@ -459,23 +1400,26 @@ def gen_str(gen):
 	for item in gen:
 		yield str(item)
 
-def match_forward(text, find, against, start=0, stop=-1):
-	"""This will find the index of the closing parantheses.
-	'find' is the closing character, 'against' is the opening char."""
+def match_paren(text, start=0):
+	"""Returns the index of the CLOSE_PAREN that balances an OPEN_PAREN just before start, or -1.
+	Jumps from paren to paren with paren_re, so parens inside string literals do not count.
+
+		>>> match_paren("f(x, ')') + 1) tail", 0)
+		13
+	"""
 	count = 1
-	if stop == -1:
-		stop = len(text)
-	for i in range(start,stop):
-		if text[i] == against:
+	for m in paren_re.finditer(text, start):
+		c = m.group(0)
+		if c == OPEN_PAREN:
 			count += 1
-		elif text[i] == find:
+		elif c == CLOSE_PAREN:
 			count -= 1
-		if count == 0:
-			return i
+			if count == 0:
+				return m.start()
 	return -1
 
 class Transformer(ast.NodeTransformer):
-	def __init__(self, stripWhitespace=False, encoding=None, root=None):
+	def __init__(self, stripWhitespace=False, encoding=None, root=None, autoEscape=False):
 		ast.NodeTransformer.__init__(self)
 		# seenStore is a map of variables that are created within the template (not passed in)
 		self.seenStore = {
@@ -485,54 +1429,82 @@ class Transformer(ast.NodeTransformer):
 		}
 		# seenFuncs is a map of the functions that are defined in the template ("def foo(): ...")
 		self.seenFuncs = {}
+		# generatorFuncs marks which of those are generators (macros), rather than functions that return a value
+		self.generatorFuncs = {}
 		self.encoding = encoding
 		self.stripWhitespace = stripWhitespace
+		self.autoEscape = autoEscape
 		self.root = root if root is not None else []
-		self.preamble = []
+		# full_name -> mtime of every file included while transforming
+		self.dependencies = {}
+		# the names read from the keyword arguments, in order of first use (a dict used as an ordered set)
+		self.argNames = {}
+		# the files being included, outermost first, to catch an include cycle
+		self.including = []
+		# how many parallel includes, and cache blocks, have been made into functions, to name them uniquely
+		self.parallelCount = 0
+		self.fragmentCount = 0
+		# the blocks of the templates that extend this one, by name, and the names of those being filled in (see: extend)
+		self.overrides = {}
+		self.filling = set()
 
 	def visit_Expr(self, node):
 		""" When capturing a call to include, we must grab it here, so we can replace the whole Expr(Call('include')).
 		"""
 		if type(node.value) is Call:
 			call = node.value
+			if type(call.func) is Name and call.func.id == 'flush':
+				# yield the marker that makes a chunked stream flush (see: _chunks), which is empty everywhere else
+				return ast.copy_location(Expr(value=Yield(value=Name(id='_flush', ctx=Load()))), node)
 			if type(call.func) is Name and call.func.id == 'include':
 				if len(call.args) < 1:
 					raise FormatError("include requires at least a filename as an argument.")
 				root = None
-				# if the original call to include had an additional argument
-				# use that argument as the root
-				# print('call',ast.dump(call))
-				if len(call.args) > 1:
-					root = call.args[1].s
-				# or if there was a root= kwarg provided, use that
-				elif len(call.keywords) > 0:
-					for k in call.keywords:
-						if k.arg == "root":
-							root = k.value.s
-				if root is None:
-					# if we didn't get one from the call to include
-					# look for one that was given as an argument to the template() call
-					root = self.root
-				if type(root) is str:
-					root = root.split(os.path.sep)
-				# the first argument to include() is the filename
-				template_name = call.args[0].s
+				parallel = False
+				for k in call.keywords:
+					if k.arg == "parallel":
+						parallel = k.value.value
+				rootArg = call.args[1] if len(call.args) > 1 else next((k.value for k in call.keywords if k.arg == "root"), None)
+				if not _isStrConstant(call.args[0]) or (rootArg is not None and not _isStrConstant(rootArg)):
+					# the file to include is only known at runtime, so it can't be inlined
+					return self.dynamicInclude(call.args[0], rootArg, parallel, node)
 				# get the ast tree that comes from this included file
-				check, fundef = include_ast(template_name, root)
-				# each include produces the code to execute, plus some code to check for freshness
-				# this code absolutely must run first, because we can't restart the generator once it has already yielded
-				self.preamble.append(check)
+				full_name, mtime, fundef = include_ast(call.args[0].s, self.includeRoot(call))
+				if os.path.normpath(full_name) in self.including:
+					cycle = self.including[self.including.index(os.path.normpath(full_name)):] + [os.path.normpath(full_name)]
+					raise FormatError("include cycle: %s" % " -> ".join(cycle))
+				# each include produces the code to execute, plus a dependency that the Template will check for freshness
+				# that check absolutely must run first, because we can't restart the generator once it has already yielded
+				# the included file's own includes are dependencies too, since they are inlined as well
+				self.dependencies[full_name] = mtime
 				if fundef is None:
 					raise FormatError("include_ast returned None")
 				# return a copy of the the cached ast tree, because it will be further modified to fit with the including template
 				fundef = copy.deepcopy(fundef)
 				_yieldall(fundef.body)
+				body = []
+				self.including.append(os.path.normpath(full_name))
 				for expr in fundef.body:
-					self.visit(expr)
-				return fundef.body
+					new = self.visit(expr)
+					# a nested include (or cache block) becomes a list of statements, anything else was changed in place
+					body.extend(new if type(new) is list else [expr])
+				self.including.pop()
+				if parallel and _isGenerator(body):
+					self.parallelCount += 1
+					return _parallel_ast(body, '_include_%d' % self.parallelCount, node)
+				return body
 		elif type(node.value) is Yield:
 			y = node.value
-			if type(y.value) == Str:
+			# expand any filters first, so their names are not mistaken for arguments
+			before = set(n.id for n in ast.walk(y) if type(n) is Name)
+			if type(y.value) is BinOp and type(y.value.op) is Mod and _isStrConstant(y.value.left):
+				y.value.right = _expandFilters(y.value.right, collections.ChainMap(self.seenStore, self.seenFuncs))
+			else:
+				y.value = _expandFilters(y.value, collections.ChainMap(self.seenStore, self.seenFuncs))
+			for n in ast.walk(y):
+				if type(n) is Name and n.id not in before:
+					self.seenStore[n.id] = True # a global helper, or builtin, used by a filter (see: Filter.apply)
+			if isinstance(y.value, Str):
 				if self.stripWhitespace:
 					s = strip_whitespace(y.value.s)
 					if len(s) == 0:
@@ -542,19 +1514,147 @@ class Transformer(ast.NodeTransformer):
 			elif type(y.value) == Call:
 				call = y.value
 				if type(call.func) is Name:
-					if self.seenFuncs.get(call.func.id, False) is not False: # was defined locally
+					if self.generatorFuncs.get(call.func.id, False): # a macro, defined locally
+						# stream its output straight into ours: yield from Call
+						node.value = ast.copy_location(YieldFrom(value=call), y)
+						call.streamed = True # see: visit_Call
+					elif self.seenFuncs.get(call.func.id, False) is not False: # was defined locally
 						# replace the Call with one to ''.join(Call)
 						y.value = _call(Attribute(value=Str(s=''), attr='join', ctx=Load()), [y.value])
 						ast.copy_location(y.value, node)
 		self.generic_visit(node)
 		return node
 
+	def includeRoot(self, call):
+		""" The root (a list) where the file named by a call to include() or extends() is found. """
+		root = None
+		# if the original call to include had an additional argument
+		# use that argument as the root
+		if len(call.args) > 1:
+			root = call.args[1].s
+		# or if there was a root= kwarg provided, use that
+		elif len(call.keywords) > 0:
+			for k in call.keywords:
+				if k.arg == "root":
+					root = k.value.s
+		if root is None:
+			# if we didn't get one from the call to include
+			# look for one that was given as an argument to the template() call
+			root = self.root
+		if type(root) is str:
+			root = root.split(os.path.sep)
+		return root
+
+	def extend(self, body):
+		""" If body, the top level of a template, calls extends('base'), returns the body of base instead,
+			and keeps the blocks of body in self.overrides, so visit_With replaces each block of base with the one of the same name.
+			That includes the blocks of any file base includes, since those are only inlined during the visit.
+			Anything else in body that produces no output (imports, assignments, defs...) is kept, and runs first.
+			This repeats if base extends another template, and so on, so everything is flattened into a single function.
+		"""
+		overrides = self.overrides
+		prelude = []
+		extended = list(self.including)
+		while True:
+			call = next((expr.value for expr in body if type(expr) is Expr and type(expr.value) is Call
+				and type(expr.value.func) is Name and expr.value.func.id == 'extends'), None)
+			if call is None:
+				break
+			if len(call.args) < 1 or not _isStrConstant(call.args[0]):
+				raise FormatError("extends requires a filename (a string literal) as an argument.")
+			for node in ast.walk(Module(body=body, type_ignores=[])):
+				name = _blockName(node)
+				if name is not None and name not in overrides: # the most derived template's block wins
+					overrides[name] = node.body
+			prelude.extend(expr for expr in body if not (type(expr) is Expr and expr.value is call)
+				and _blockName(expr) is None and not _isGenerator([expr]))
+			full_name, mtime, fundef = include_ast(call.args[0].s, self.includeRoot(call))
+			if os.path.normpath(full_name) in extended:
+				raise FormatError("extends cycle: %s" % " -> ".join(extended[extended.index(os.path.normpath(full_name)):] + [os.path.normpath(full_name)]))
+			extended.append(os.path.normpath(full_name))
+			self.dependencies[full_name] = mtime
+			body = copy.deepcopy(fundef.body)
+			_yieldall(body)
+		return prelude + body
+
+	def dynamicInclude(self, filename, root, parallel, node):
+		""" yield from _include(filename, root, args, locals())
+			Which renders the file as its own Template, with the keyword arguments and local variables of this one (see: Template._include).
+		"""
+		self.visit(filename)
+		if root is not None:
+			self.visit(root)
+		gen = _call(Name(id='_include', ctx=Load()), [filename, root if root is not None else Constant(value=None),
+			Name(id='args', ctx=Load()), _call(Name(id='locals', ctx=Load()), [])])
+		if parallel:
+			return ast.copy_location(Expr(value=Yield(value=_call(Name(id='_parallel', ctx=Load()), [gen]))), node)
+		return ast.copy_location(Expr(value=YieldFrom(value=gen)), node)
+
+	def visit_With(self, node):
+		""" A cache block, with cache(key=..., ttl=...), becomes a macro, whose output _cache() stores or re-uses.
+			A named block, with block('name'), is inlined, or replaced by the override of the same name (see: extend).
+		"""
+		name = _blockName(node)
+		if name is not None:
+			block = node.body
+			filling = name in self.overrides and name not in self.filling
+			if filling:
+				block = copy.deepcopy(self.overrides[name])
+				self.filling.add(name) # so an override that contains a block of its own name can't recurse forever
+			body = []
+			for expr in block:
+				new = self.visit(expr)
+				if type(new) is list:
+					body.extend(new)
+				elif new is not None:
+					body.append(new)
+			if filling:
+				self.filling.discard(name)
+			return body
+		if len(node.items) != 1 or type(node.items[0].context_expr) is not Call:
+			self.generic_visit(node)
+			return node
+		call = node.items[0].context_expr
+		if type(call.func) is not Name or call.func.id != 'cache' or 'cache' in self.seenStore:
+			self.generic_visit(node)
+			return node
+		# blocks with the same code (and root, for includes) share their cached output,
+		# unless one of the options that change what the code outputs is different
+		blockId = hashlib.sha1(repr((ast.dump(Module(body=node.body, type_ignores=[])), self.root,
+			self.stripWhitespace, self.encoding, self.autoEscape)).encode('utf8')).hexdigest()
+		options = {'key': Constant(value=None), 'ttl': Constant(value=None)}
+		for i, value in enumerate(call.args):
+			options[('key', 'ttl')[i]] = value
+		for k in call.keywords:
+			if k.arg not in options:
+				raise FormatError("cache() got an unexpected argument: %s" % k.arg)
+			options[k.arg] = k.value
+		for value in options.values():
+			self.visit(value)
+		body = []
+		for expr in node.body:
+			expr = self.visit(expr)
+			if type(expr) is list:
+				body.extend(expr)
+			elif expr is not None:
+				body.append(expr)
+		if not _isGenerator(body):
+			return body # no output to cache
+		self.fragmentCount += 1
+		name = '_fragment_%d' % self.fragmentCount
+		fundef = FunctionDef(name=name, args=arguments(posonlyargs=[], args=[], vararg=None,
+				kwonlyargs=[], kw_defaults=[], kwarg=None, defaults=[]),
+			body=body, decorator_list=[], returns=None)
+		cached = _call(Name(id='_cache', ctx=Load()), [Name(id=name, ctx=Load()), Constant(value=blockId), options['key'], options['ttl']])
+		return [ast.copy_location(fundef, node), ast.copy_location(Expr(value=Yield(value=cached)), node)]
+
 	def visit_FunctionDef(self, node):
 		self.seenFuncs[node.name] = True
 		for arg in node.args.args:
 			self.seenStore[arg.arg] = True
 		# iterate over each Expr in the body, and make sure it is yielding
 		_yieldall(node.body)
+		self.generatorFuncs[node.name] = _isGenerator(node.body)
 		self.generic_visit(node)
 		return node
 
@@ -578,14 +1678,30 @@ class Transformer(ast.NodeTransformer):
 		if type(node.ctx) == ast.Load and self.seenStore.get(node.id, False) is False:
 			# check if it is a builtin, or is a function defined in the template
 			if builtins.__dict__.get(node.id,None) is None and self.seenFuncs.get(node.id,None) is None:
-				# if not, replace it with a reference to args[...]
-				new = Subscript(value=Name(id='args', ctx=Load()),
-					slice=Index(value=Str(s=node.id)), ctx=node.ctx, lineno=node.lineno)
-				return ast.copy_location(new, node)
+				# if not, it will be unpacked from args[...] into a local of the same name (see: _unpackArg)
+				self.argNames[node.id] = True
 			return node
 		else: # is Load, but a local variable
 			return node
 
+	def visit_Call(self, node):
+		""" With autoEscape, the output of a macro used as a value was escaped as it was made, so it becomes a SafeString:
+			macro(...) and ''.join(macro(...)) become _safe(''.join(macro(...)))
+		"""
+		if not self.autoEscape or getattr(node, 'streamed', False):
+			self.generic_visit(node)
+			return node
+		macro = node
+		if type(node.func) is Attribute and node.func.attr == 'join' and _isStrConstant(node.func.value) and len(node.args) == 1:
+			macro = node.args[0]
+		if type(macro) is Call and type(macro.func) is Name and self.generatorFuncs.get(macro.func.id, False):
+			macro.streamed = True # so visiting it doesn't wrap it again
+			self.generic_visit(node)
+			joined = node if macro is not node else _call(Attribute(value=Str(s=''), attr='join', ctx=Load()), [node])
+			return ast.copy_location(_call(Name(id='_safe', ctx=Load()), [joined]), node)
+		self.generic_visit(node)
+		return node
+
 	def visit_GeneratorExp(self, node):
 		# generator expressions define the variables "out-of-order"
 		# if you say: (x for x in iter), the creation of x appears
@@ -597,14 +1713,155 @@ class Transformer(ast.NodeTransformer):
 		self.generic_visit(node.elt)
 		return node
 
-def flatten_gen(gen):
-	generator = types.GeneratorType
-	for i in gen:
-		if type(i) is generator:
-			for j in i:
-				yield str(j)
+# the empty pieces yielded by %(flush()), told apart from any other empty piece by identity
+class _Flush(str): pass
+class _FlushBytes(bytes): pass
+_FLUSH = _Flush()
+_FLUSH_BYTES = _FlushBytes()
+async def _achunks(gen, size):
+	""" The async version of _chunks(), which lets the event loop run after each chunk. """
+	buf = []
+	n = 0
+	async for piece in gen:
+		if piece is _FLUSH:
+			if n > 0:
+				yield ''.join(buf)
+				await asyncio.sleep(0)
+				buf = []
+				n = 0
+			continue
+		buf.append(piece)
+		n += len(piece)
+		if n >= size:
+			yield ''.join(buf)
+			await asyncio.sleep(0)
+			buf = []
+			n = 0
+	if n > 0:
+		yield ''.join(buf)
+def _chunks(gen, size, empty):
+	""" Gathers the pieces from gen into chunks of at least size, and flushes early at each _FLUSH. """
+	buf = []
+	n = 0
+	for piece in gen:
+		if piece is _FLUSH or piece is _FLUSH_BYTES:
+			if n > 0:
+				yield empty.join(buf)
+				buf = []
+				n = 0
+			continue
+		buf.append(piece)
+		n += len(piece)
+		if n >= size:
+			yield empty.join(buf)
+			buf = []
+			n = 0
+	if n > 0:
+		yield empty.join(buf)
+
+def _parallel(gen):
+	""" Starts running gen, a section of a template, in EXECUTOR.  Returns the Future of the list of its pieces. """
+	return (EXECUTOR or _default_executor()).submit(list, gen)
+
+_executor = None
+def _default_executor():
+	global _executor
+	with _compile_lock:
+		if _executor is None:
+			_executor = concurrent.futures.ThreadPoolExecutor(thread_name_prefix="suba")
+	return _executor
+
+def _splice(pieces):
+	""" Yields the pieces, replacing each Future (see: _parallel) with the pieces it produces.
+		While a Future is still running, later pieces are pulled from the generator, which starts any later sections.
+
+		>>> f = concurrent.futures.Future(); f.set_result(['b', 'c'])
+		>>> list(_splice(iter(['a', f, 'd'])))
+		['a', 'b', 'c', 'd']
+	"""
+	Future = concurrent.futures.Future
+	pending = collections.deque()
+	for piece in pieces:
+		if not pending and not isinstance(piece, Future):
+			yield piece
+			continue
+		pending.append(piece)
+		while pending and not (isinstance(pending[0], Future) and not pending[0].done()):
+			piece = pending.popleft()
+			if isinstance(piece, Future):
+				yield from _splice(piece.result()) # the section may have parallel includes of its own
+			else:
+				yield piece
+	for piece in pending:
+		if isinstance(piece, Future):
+			yield from _splice(piece.result())
 		else:
-			yield str(i)
+			yield piece
+
+def _cache(fragment, blockId, key=None, ttl=None):
+	""" Returns the output of a cache block (see: Transformer.visit_With), rendering fragment() only if it is not stored already.
+		Templates compiled with different options never share a block's output.
+
+		>>> load(text="%(cache:)%(x)%/").render(x="<i>"), load(text="%(cache:)%(x)%/", autoEscape=True).render(x="<i>")
+		('<i>', '&lt;i&gt;')
+		>>> load(text="%(cache:)caf\\xe9%/").render_bytes(), load(text="%(cache:)caf\\xe9%/", encoding="latin-1").render_bytes()
+		(b'caf\\xc3\\xa9', b'caf\\xe9')
+		>>> load(text="%(cache:) a\\n b%/").render(), load(text="%(cache:) a\\n b%/", stripWhitespace=True).render()
+		(' a\\n b', ' ab')
+	"""
+	value = _fragment_get((blockId, key, str))
+	if value is None:
+		value = ''.join(_splice(fragment()))
+		_fragment_set((blockId, key, str), value, ttl)
+	return value
+def _cache_bytes(fragment, blockId, key=None, ttl=None):
+	value = _fragment_get((blockId, key, bytes))
+	if value is None:
+		value = b''.join(_splice(fragment()))
+		_fragment_set((blockId, key, bytes), value, ttl)
+	return value
+async def _cache_async(fragment, blockId, key=None, ttl=None):
+	value = _fragment_get((blockId, key, str))
+	if value is None:
+		value = ''.join([piece async for piece in fragment()])
+		_fragment_set((blockId, key, str), value, ttl)
+	return value
+
+def _fragment_get(key):
+	entry = (FRAGMENT_CACHE if FRAGMENT_CACHE is not None else _fragment_cache).get(key)
+	# each entry is (expires, value), so the store itself need not know about ttl
+	if entry is not None and (entry[0] is None or entry[0] > time.time()):
+		_fragment_counts['hits'] += 1
+		return entry[1]
+	_fragment_counts['misses'] += 1
+	return None
+def _fragment_set(key, value, ttl):
+	(FRAGMENT_CACHE if FRAGMENT_CACHE is not None else _fragment_cache).set(key, (time.time() + ttl if ttl is not None else None, value))
+
+class SafeString(str):
+	""" A str that is already safe to output as HTML, so autoEscape leaves it alone. """
+	def __html__(self):
+		return self
+
+def _escape(v):
+	""" The HTML-escaped str of v, unless v is already safe: it has an __html__ method, like SafeString (or markupsafe's Markup).
+
+		>>> _escape("<a href='x'>&</a>"), _escape(SafeString("<br>")), _escape(1)
+		('&lt;a href=&#39;x&#39;&gt;&amp;&lt;/a&gt;', '<br>', '1')
+	"""
+	if type(v) is not str:
+		html = getattr(v, '__html__', None)
+		if html is not None:
+			return html()
+		v = _flatten_str(v)
+	# for the short values templates mostly see, this is faster than str.translate (or html.escape)
+	return v.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;').replace("'", '&#39;')
+
+def _flatten_str(v):
+	""" The str() of a value, or of everything a generator (of generators...) yields, joined. """
+	if type(v) is types.GeneratorType:
+		return ''.join([i if type(i) is str else _flatten_str(i) for i in v])
+	return str(v)
 
 def strip_whitespace(s):
 	out = io.StringIO()
@@ -618,20 +1875,365 @@ def strip_whitespace(s):
 			out.write(c)
 	return out.getvalue()
 
-_code_cache = {}
+class LRUCache:
+	""" A bounded mapping that evicts the least recently used entry once it holds more than capacity entries.
+
+		>>> c = LRUCache(capacity=2)
+		>>> c.set('a', 1, path='a.suba'); c.set('b', 2); c.get('a')
+		1
+		>>> c.set('c', 3); c.get('b') is None
+		True
+		>>> c.invalidate('./a.suba'); len(c)
+		1
+		>>> c.stats()
+		{'size': 1, 'capacity': 2, 'hits': 1, 'misses': 1, 'evictions': 1}
+	"""
+	def __init__(self, capacity=None):
+		self.capacity = capacity # None means: use CACHE_SIZE
+		self.entries = collections.OrderedDict() # key -> (path, value)
+		self.hits = self.misses = self.evictions = 0
+		self.lock = threading.Lock()
+	def get(self, key, default=None):
+		with self.lock:
+			try:
+				path, value = self.entries[key]
+			except KeyError:
+				self.misses += 1
+				return default
+			self.entries.move_to_end(key)
+			self.hits += 1
+			return value
+	def set(self, key, value, path=None):
+		""" Stores value under key.  If path is given, invalidate(path) will remove this entry. """
+		with self.lock:
+			self.entries[key] = (os.path.normpath(path) if path is not None else None, value)
+			self.entries.move_to_end(key)
+			capacity = self.capacity if self.capacity is not None else CACHE_SIZE
+			while len(self.entries) > capacity:
+				self.entries.popitem(last=False)
+				self.evictions += 1
+	def invalidate(self, path):
+		""" Removes every entry that was compiled from path. """
+		path = os.path.normpath(path)
+		with self.lock:
+			for key in [k for k, (p, _) in self.entries.items() if p == path]:
+				del self.entries[key]
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+	def stats(self):
+		return {'size': len(self.entries), 'capacity': self.capacity if self.capacity is not None else CACHE_SIZE, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+	def __len__(self):
+		return len(self.entries)
+
+# holds both compiled Templates, and the FunctionDef trees of included files
+_code_cache = LRUCache()
+# held while compiling, so concurrent first requests for a template only compile it once
+_compile_lock = threading.RLock()
+def clear_cache():
+	""" Drops every compiled template from the in-memory cache. """
+	_code_cache.clear()
+def invalidate(path):
+	""" Drops every compiled template, or included file, that was read from path,
+		and marks every Template that includes it (even through other includes) stale, so it reloads before its next render. """
+	_code_cache.invalidate(path)
+	_graph.changed(path)
+def cache_stats():
+	""" Returns a dict with the size, capacity, hits, misses, and evictions of the in-memory cache. """
+	return _code_cache.stats()
+
+# the default store for the output of %(cache:) blocks (see: FRAGMENT_CACHE)
+_fragment_cache = LRUCache()
+_fragment_counts = {'hits': 0, 'misses': 0}
+def fragment_stats():
+	""" Returns a dict with the hits and misses of every %(cache:) block, and the size of the store, if it has one. """
+	store = FRAGMENT_CACHE if FRAGMENT_CACHE is not None else _fragment_cache
+	return dict(_fragment_counts, size=len(store) if hasattr(store, '__len__') else None)
+def clear_fragments():
+	""" Drops the output of every %(cache:) block from the store, and resets the hits and misses. """
+	(FRAGMENT_CACHE if FRAGMENT_CACHE is not None else _fragment_cache).clear()
+	_fragment_counts['hits'] = _fragment_counts['misses'] = 0
+
+class DependencyGraph:
+	""" Maps each file to the live Templates built from it, directly or through includes (of includes...).
+		When a file changes, exactly those Templates are marked stale, and each one reloads before its next render.
+
+		>>> os.makedirs("_test", exist_ok=True)
+		>>> f = open("_test/header.suba", "w"); f.write("<h1>"); f.close()
+		4
+		>>> f = open("_test/page.suba", "w"); f.write("%(include('header.suba'))page"); f.close()
+		29
+		>>> page = load(filename="page.suba", root="_test")
+		>>> other = load(text="other")
+		>>> sorted(os.path.basename(t.filename) for t in _graph.templates(os.path.join("_test", "header.suba")))
+		['page.suba']
+		>>> invalidate("_test/header.suba")
+		>>> page.stale, other.stale
+		(True, False)
+		>>> page.render()
+		'<h1>page'
+		>>> page.stale
+		False
+
+		A Template built from an older copy of a file than some other Template has seen is stale right away.
+
+		>>> _graph.add(page, {os.path.join("_test", "header.suba"): 0})
+		>>> page.stale, page.render(), page.stale
+		(True, '<h1>page', False)
+
+		A file replaced by a copy with an older mtime, such as a rolled back deploy, has changed as well.
+
+		>>> os.utime("_test/header.suba", (1, 1))
+		>>> page.render(), load(text="%(include('header.suba'))", root="_test").render(), page.stale
+		('<h1>page', '<h1>', False)
+
+		Each file is only stat()ed once per check, however many Templates include it.
+		An include cycle can't be inlined, so it is an error.
+
+		>>> f = open("_test/header.suba", "w"); f.write("%(include('page.suba'))"); f.close()
+		23
+		>>> load(filename="page.suba", root="_test", skipCache=True)
+		Traceback (most recent call last):
+		...
+		suba.FormatError: include cycle: _test/page.suba -> _test/header.suba -> _test/page.suba
+		>>> os.remove("_test/header.suba"); os.remove("_test/page.suba")
+	"""
+	def __init__(self):
+		self.dependents = {} # normpath -> WeakSet of Templates
+		self.mtimes = {} # normpath -> the mtime the file had when it was last seen
+		self.lock = threading.Lock()
+	def add(self, template, dependencies):
+		""" Records that template was built from each file in dependencies (full_name -> mtime). """
+		for full_name, mtime in dependencies.items():
+			path = os.path.normpath(full_name)
+			with self.lock:
+				known = self.mtimes.get(path)
+				if known is None:
+					self.mtimes[path] = mtime
+				templates = self.dependents.setdefault(path, weakref.WeakSet())
+			if known is not None and mtime != known:
+				# template was built from a different copy of this file than the others, so see which one is on disk now
+				try:
+					current = os.path.getmtime(path)
+				except OSError:
+					current = None
+				if current != mtime:
+					# template was built from a copy that is gone (such as one in cacheDir), check() would never notice
+					template.stale = True
+				if current != known:
+					self.changed(path, current, keep=None if current != mtime else template)
+			templates.add(template)
+	def templates(self, path):
+		""" The live Templates that were built from path. """
+		with self.lock:
+			return list(self.dependents.get(os.path.normpath(path), ()))
+	def changed(self, path, mtime=None, keep=None):
+		""" Marks every Template built from path stale (except keep), and forgets the compiled copy of path. """
+		path = os.path.normpath(path)
+		with self.lock:
+			if mtime is not None:
+				self.mtimes[path] = mtime
+			else:
+				self.mtimes.pop(path, None)
+			templates = list(self.dependents.get(path, ()))
+		for t in templates:
+			if t is not keep:
+				t.stale = True
+	def check(self, paths=None):
+		""" Stats each of paths (default: every known file) once, and marks the Templates built from a changed file stale. """
+		if paths is None:
+			with self.lock:
+				paths = [p for p, templates in self.dependents.items() if len(templates) > 0]
+		for full_name in paths:
+			path = os.path.normpath(full_name)
+			try:
+				mtime = os.path.getmtime(path)
+			except OSError:
+				mtime = None # removed, so every Template built from it must reload (and fail)
+			with self.lock:
+				known = self.mtimes.get(path)
+			if known is None or mtime is None or mtime != known: # newer, or older, such as a rolled back deploy
+				self.changed(path, mtime)
+
+_graph = DependencyGraph()
+_watcher = None
+def _start_watcher():
+	""" Starts the background thread that marks Templates stale when FRESHNESS is 'watcher'. """
+	global _watcher
+	if _watcher is None:
+		with _compile_lock:
+			if _watcher is None:
+				_watcher = threading.Thread(target=_watch, name="suba-watcher", daemon=True)
+				_watcher.start()
+def _watch():
+	while True:
+		time.sleep(WATCH_INTERVAL)
+		_graph.check()
+
 def include_ast(filename, root=None):
 	if root is None:
 		root = []
 	full_name = os.path.sep.join(root + [f for f in filename.split(os.path.sep) if f != '..' and f != ''])
-	h = full_name.__hash__()
-	m = os.path.getmtime(full_name)
-	h += m
-	if _code_cache.get(h,None) is None:
+	st = os.stat(full_name)
+	m = st.st_mtime
+	h = ('include', os.path.normpath(full_name), st.st_mtime_ns, st.st_size)
+	fundef = _code_cache.get(h)
+	if fundef is None:
 		with open(full_name) as f:
 			module = compile_ast(f.read(), transform=False)
 			fundef = module.body[0] # cache the only element of the included Module's body, the function defintion
-			_code_cache[h] = fundef
-	return _checkMtimeAndYield(full_name, m), _code_cache[h]
+			_code_cache.set(h, fundef, path=full_name)
+	return full_name, m, fundef
+
+def _disk_cache_file(cacheDir, filename, text, stripWhitespace, encoding, root, autoEscape):
+	""" The name of the file in cacheDir that holds the code for this source, compiled with these options. """
+	# the same options as the in-memory key (see: load), in the same order
+	options = (stripWhitespace, encoding, tuple(root), autoEscape)
+	key = repr((filename, hashlib.sha1(text.encode('utf8')).hexdigest(), importlib.util.MAGIC_NUMBER, options))
+	return os.path.join(cacheDir, hashlib.sha1(key.encode('utf8')).hexdigest() + '.subac')
+def _includeArgs(args, scope):
+	""" The keyword arguments for a dynamic include: args, plus the template's own variables from scope, its locals().
+		The names the compiled code uses itself (such as os, args, _buf, _value) are left out, so every render mode passes the same. """
+	kw = dict(args)
+	for k, v in scope.items():
+		if k[0] != '_' and k not in ('os', 'args'):
+			kw[k] = v
+	return kw
+
+def _checkPolicy(freshness):
+	""" Returns freshness, if it is None or a policy that FRESHNESS allows, or raises ValueError. """
+	if freshness is None or freshness in ('always', 'watcher', 'frozen') or (type(freshness) in (int, float) and freshness >= 0):
+		return freshness
+	raise ValueError("freshness must be 'always', 'watcher', 'frozen' or a number of seconds, not %r" % (freshness,))
+
+def _modified(dependencies):
+	""" True if any of dependencies (full_name -> mtime) has changed since that mtime, or is gone. """
+	for full_name, mtime in dependencies.items():
+		try:
+			if os.path.getmtime(full_name) != mtime: # newer, or older, such as a rolled back deploy
+				return True
+		except OSError:
+			return True
+	return False
+def _read_disk_cache(cache_file):
+	""" Returns the (code, dependencies) stored in cache_file, or None if it is missing or unreadable. """
+	try:
+		with open(cache_file, "rb") as f:
+			data = f.read()
+	except OSError:
+		return None
+	magic = importlib.util.MAGIC_NUMBER
+	if data[:len(magic)] != magic:
+		return None
+	try:
+		return marshal.loads(data[len(magic):])
+	except (EOFError, ValueError, TypeError):
+		return None
+def _write_disk_cache(cache_file, code, dependencies):
+	""" Atomically replaces cache_file with the marshalled code, so concurrent readers never see a partial file. """
+	cacheDir = os.path.dirname(cache_file)
+	try:
+		os.makedirs(cacheDir, exist_ok=True)
+		fd, tmp = tempfile.mkstemp(dir=cacheDir, suffix='.tmp')
+		try:
+			with os.fdopen(fd, "wb") as f:
+				f.write(importlib.util.MAGIC_NUMBER + marshal.dumps((code, dependencies)))
+			os.replace(tmp, cache_file)
+		except:
+			os.remove(tmp)
+			raise
+	except OSError:
+		pass # the disk cache is only an optimization, failing to write it is not an error
+
+class Filter:
+	""" A filter, as in %(name|upper|truncate(20)).  Either func is called at runtime, as func(value, *args),
+		or inline(value, args) returns the ast of an expression that is compiled in place of the filter.
+		If nargs is given, as (fewest, most), a filter given any other number of arguments is a FormatError.
+
+		>>> load(text="%(x|truncate)")
+		Traceback (most recent call last):
+		...
+		suba.FormatError: The filter truncate takes 1 argument(s), but was given 0.
+	"""
+	def __init__(self, func=None, inline=None, nargs=None):
+		self.func = func
+		self.inline = inline
+		self.nargs = nargs
+	def apply(self, name, value, args):
+		if self.nargs is not None and not (self.nargs[0] <= len(args) <= self.nargs[1]):
+			n = self.nargs[0] if self.nargs[0] == self.nargs[1] else "%d to %d" % self.nargs
+			raise FormatError("The filter %s takes %s argument(s), but was given %d." % (name, n, len(args)))
+		if self.inline is not None:
+			return self.inline(value, args)
+		return _call(Name(id='_filter_' + name, ctx=Load()), [value] + args)
+
+# the filters that templates can use, by name
+# filters are applied when a template is compiled, so changes here only apply to templates compiled afterwards
+FILTERS = {}
+def add_filter(name, func=None, inline=None):
+	""" Makes a filter available to templates.  Give either func, called at runtime with the value (and any arguments),
+		or inline, which is given the ast of the value (and of any arguments), and returns the ast to compile in its place.
+
+		>>> add_filter('shout', lambda value, n=1: value + '!' * n)
+		>>> add_filter('twice', inline=lambda value, args: BinOp(left=value, op=Mult(), right=Num(n=2)))
+		>>> load(text="%(name|upper|shout(2)) %(n|twice)d").render(name="ringo", n=21)
+		'RINGO!! 42'
+	"""
+	if (func is None) == (inline is None):
+		raise TypeError("add_filter requires either func or inline.")
+	FILTERS[name] = Filter(func=func, inline=inline)
+
+def _expandFilters(node, local=()):
+	""" Replaces value|name|name(args)... with the filters applied to value, innermost first.
+		Anything else, including a | whose right side is not the name of a filter, is returned as is.
+		A name in local is a variable of the template, so it is never a filter.
+		An argument with the name of a filter can still be used with |, as args['name'].
+
+		>>> print(ast.unparse(_expandFilters(ast.parse("x|length", mode='eval').body)))
+		len(x)
+		>>> print(ast.unparse(_expandFilters(ast.parse("x|length", mode='eval').body, {'length'})))
+		x | length
+	"""
+	if type(node) is not BinOp or type(node.op) is not BitOr:
+		return node
+	f = node.right
+	if type(f) is Name:
+		name, args = f.id, []
+	elif type(f) is Call and type(f.func) is Name and len(f.keywords) == 0:
+		name, args = f.func.id, f.args
+	else:
+		return node
+	if name not in FILTERS or name in local:
+		return node
+	return ast.copy_location(FILTERS[name].apply(name, _expandFilters(node.left, local), args), node)
+
+def _asStr(value):
+	""" str(value), unless value is already known to be a str """
+	return value if _isStr(value) else _call(Name(id='str', ctx=Load()), [value])
+
+def _strMethod(method):
+	""" An inline filter: str(value).method(*args) """
+	return lambda value, args: _call(Attribute(value=_asStr(value), attr=method, ctx=Load()), args)
+
+for _name in ('upper', 'lower', 'strip', 'title', 'capitalize'):
+	FILTERS[_name] = Filter(inline=_strMethod(_name), nargs=(0, 0))
+FILTERS.update({
+	'q': Filter(inline=lambda value, args: _quote(value).value, nargs=(0, 0)),
+	'm': Filter(inline=lambda value, args: _multiline(value).value, nargs=(0, 0)),
+	# str(value)[:n]
+	'truncate': Filter(inline=lambda value, args: Subscript(value=_asStr(value),
+		slice=Slice(lower=None, upper=args[0], step=None), ctx=Load()), nargs=(1, 1)),
+	# value or d
+	'default': Filter(inline=lambda value, args: BoolOp(op=Or(), values=[value, args[0]]), nargs=(1, 1)),
+	# sep.join(map(str, value))
+	'join': Filter(inline=lambda value, args: _call(Attribute(value=args[0] if len(args) > 0 else Str(s=''), attr='join', ctx=Load()),
+		[_call(Name(id='map', ctx=Load()), [Name(id='str', ctx=Load()), value])]), nargs=(0, 1)),
+	'length': Filter(inline=lambda value, args: _call(Name(id='len', ctx=Load()), [value]), nargs=(0, 0)),
+	# _safe(_escape(value)), so autoEscape doesn't escape it again
+	'escape': Filter(inline=lambda value, args: _call(Name(id='_safe', ctx=Load()), [_call(Name(id='_escape', ctx=Load()), [value])]), nargs=(0, 0)),
+	'safe': Filter(inline=lambda value, args: _call(Name(id='_safe', ctx=Load()), [value]), nargs=(0, 0)),
+})
+del _name
 
 # these are quick utils for building ast
 def _call(func,args):
@@ -646,25 +2248,108 @@ def _quote(node):
 def _multiline(node):
 	""" node.replace('\n','\\n') """
 	return Expr(value=_call(_replace(node), [Str(s='\n'),Str(s="\\\n")]))
-def _compareMtime(full_name, mtime):
-	""" os.path.getmtime(full_name) > mtime """
-	return Compare(left=Call(func=Attribute(value=Attribute(value=Name(id='os', ctx=Load(), lineno=0), attr='path', ctx=Load()),
-		attr='getmtime', ctx=Load()), args=[Str(s=full_name)], keywords=[], starargs=None, kwargs=None),
-		ops=[Gt()],
-		comparators=[Num(n=mtime)])
-def _checkMtimeAndYield(full_name, mtime):
-	""" if os.path.getmtime(full_name) > mtime:
-		yield ResourceModified(full_name)
-	""" # static checks like this are compiled into the top of include trees
-	return If(test=_compareMtime(full_name, mtime), body=[
-		Expr(value=Yield(value=Call(func=Name(id='ResourceModified', ctx=Load(), lineno=0),
-			args=[Str(s=full_name)], keywords=[], starargs=None, kwargs=None)))
-	], orelse=[])
+def _unpackArg(name):
+	""" try: name = args['name']
+		except KeyError: pass
+	""" # a missing argument is only an error (see: Template._missingArg) if the template actually reaches a read of it
+	node = Try(body=[Assign(targets=[Name(id=name, ctx=Store())],
+			value=Subscript(value=Name(id='args', ctx=Load()), slice=Index(value=Str(s=name)), ctx=Load()))],
+		handlers=[ExceptHandler(type=Name(id='KeyError', ctx=Load()), name=None, body=[Pass()])],
+		orelse=[], finalbody=[])
+	node.argName = name # so AsyncTransformer can find it
+	return node
+def _parallel_ast(body, name, node):
+	""" Makes body into a macro, and yields the Future of running it in parallel (see: _parallel).
+		Every name the body reads is passed in as an argument, so it sees the values from the time of the include.
+		So a parallel include can't set variables for the template around it.
+	"""
+	names = _freeNames(body)
+	fundef = FunctionDef(name=name, args=arguments(posonlyargs=[], args=[arg(arg=n) for n in names], vararg=None,
+			kwonlyargs=[], kw_defaults=[], kwarg=None, defaults=[]),
+		body=body, decorator_list=[], returns=None)
+	call = _call(Name(id=name, ctx=Load()), [Name(id=n, ctx=Load()) for n in names])
+	return [ast.copy_location(fundef, node), ast.copy_location(Expr(value=Yield(value=_call(Name(id='_parallel', ctx=Load()), [call]))), node)]
+
+def _blockName(node):
+	""" The name of a block, if node is one: with block('name'): ... """
+	if type(node) is With and len(node.items) == 1:
+		call = node.items[0].context_expr
+		if type(call) is Call and type(call.func) is Name and call.func.id == 'block' and len(call.args) == 1 and _isStrConstant(call.args[0]):
+			return call.args[0].value
+	return None
+
+def _isStrConstant(node):
+	return type(node) is Constant and type(node.value) is str
+
+def _isParallel(value):
+	return type(value) is Call and type(value.func) is Name and value.func.id == '_parallel'
+
+def _freeNames(body):
+	""" The names that body reads, but never assigns.
+
+		>>> _freeNames(ast.parse("for i in range(n): yield i + x").body)
+		['range', 'n', 'x']
+	"""
+	loads, stores = {}, set()
+	for node in ast.walk(Module(body=body, type_ignores=[])):
+		if type(node) is Name:
+			if type(node.ctx) is Load:
+				loads[node.id] = True
+			else:
+				stores.add(node.id)
+		elif type(node) is arg:
+			stores.add(node.arg)
+		elif type(node) in (FunctionDef, AsyncFunctionDef, ClassDef):
+			stores.add(node.name)
+		elif type(node) is alias:
+			stores.add((node.asname or node.name).split('.')[0])
+	return [n for n in loads if n not in stores]
+
+def _usesName(code, name):
+	""" True if code, or any code nested inside it, refers to the global name. """
+	if name in code.co_names:
+		return True
+	return any(type(c) is types.CodeType and _usesName(c, name) for c in code.co_consts)
+def _globalNames(code):
+	""" Every global name that code, or any code nested inside it, refers to. """
+	names = set(code.co_names)
+	for c in code.co_consts:
+		if type(c) is types.CodeType:
+			names |= _globalNames(c)
+	return names
+
+def _valueMacros(fundef):
+	""" The names of the macros defined in fundef whose output is used as a value somewhere,
+		rather than only streamed into the output (by yield from, _cache, or _parallel).
+
+		>>> sorted(_valueMacros(ast.parse("def execute():\\n def a(): yield 1\\n def b(): yield 2\\n yield from a()\\n yield from b()\\n yield _str(b())").body[0]))
+		['b']
+	"""
+	macros = set(n.name for n in ast.walk(fundef) if type(n) is FunctionDef and n is not fundef and _isGenerator(n.body))
+	streamed = set() # the Name nodes that only refer to a macro to stream it
+	for node in ast.walk(fundef):
+		if type(node) is YieldFrom and type(node.value) is Call:
+			streamed.add(node.value.func)
+		elif type(node) is Call and type(node.func) is Name and node.func.id in ('_cache', '_parallel') and len(node.args) > 0:
+			first = node.args[0]
+			streamed.add(first.func if type(first) is Call else first)
+	return set(n.id for n in ast.walk(fundef) if type(n) is Name and n.id in macros and n not in streamed)
+
+def _isGenerator(body):
+	""" True if the statements in body yield, not counting any functions defined inside them. """
+	todo = list(body)
+	while len(todo) > 0:
+		node = todo.pop()
+		if type(node) in (Yield, YieldFrom):
+			return True
+		if type(node) not in (FunctionDef, ClassDef, Lambda):
+			todo.extend(ast.iter_child_nodes(node))
+	return False
 def _yieldall(body):
 	for i in range(len(body)):
 		expr = body[i]
 		if type(expr) is Expr:
-			if type(expr.value) != Yield and not (type(expr.value) is Call and type(expr.value.func) is Name and expr.value.func.id is 'include'):
+			if type(expr.value) not in (Yield, YieldFrom) and not (type(expr.value) is Call and type(expr.value.func) is Name and expr.value.func.id in ('include', 'flush', 'extends')):
 				new = Yield(value=expr.value)
 				body[i].value = ast.copy_location(new, expr.value)
 
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
-import os, sys
+import os, sys, asyncio
 sys.path.insert(0,"..")
-from suba import template
+from suba import template, load
 
 test_to_run = None
 if len(sys.argv) > 1:
@@ -10,18 +10,29 @@ if len(sys.argv) > 1:
 for file in os.listdir("."):
 	if file.endswith(".test"):
 		if test_to_run is None or file.startswith(test_to_run):
-			try:
-				output = ''.join(template(filename=file, root=".", stripWhitespace=True, names = ['John','Paul','Ringo']))
-			except Exception as e:
-				output = str(e)
-				if test_to_run is not None:
-					raise
 			correct = open(os.path.sep.join([".",file.replace(".test",".output")]), "r").read()[:-1]
-			if output != correct:
-				print(file,"FAIL:")
-				print("EXPECTED:")
-				print(correct)
-				print("GOT:")
-				print(output)
-			else:
-				print(file, "PASS.")
+			# every test is run through both the streaming and the buffered code, in str and in bytes, and async
+			for mode in ("stream", "render", "stream_bytes", "render_bytes", "render_async"):
+				try:
+					if mode == "stream":
+						output = ''.join(template(filename=file, root=".", stripWhitespace=True, names = ['John','Paul','Ringo']))
+					elif mode == "render":
+						output = load(filename=file, root=".", stripWhitespace=True).render(names = ['John','Paul','Ringo'])
+					elif mode == "stream_bytes":
+						output = b''.join(load(filename=file, root=".", stripWhitespace=True).stream_bytes(names = ['John','Paul','Ringo'])).decode("utf8")
+					elif mode == "render_bytes":
+						output = load(filename=file, root=".", stripWhitespace=True).render_bytes(names = ['John','Paul','Ringo']).decode("utf8")
+					else:
+						output = asyncio.run(load(filename=file, root=".", stripWhitespace=True).render_async(names = ['John','Paul','Ringo']))
+				except Exception as e:
+					output = str(e)
+					if test_to_run is not None:
+						raise
+				if output != correct:
+					print(file,"FAIL (%s):" % mode)
+					print("EXPECTED:")
+					print(correct)
+					print("GOT:")
+					print(output)
+				else:
+					print(file, "PASS (%s)." % mode)